@@ -0,0 +1,53 @@
+"""
+An in-process stand-in for the RQ backend, for the benchmarks.
+"""
+
+import functools
+
+from stream_analysis.backends import LocalBackend, _run_local_job
+
+
+class QueueBackend(LocalBackend):
+    """
+    A local backend that holds jobs in a list until they are drained,
+    so that creating and analyzing frames can be measured separately.
+
+    Counts the calls that would each be (at least) one Redis round trip.
+    """
+
+    ROUND_TRIP_METHODS = (
+        'enqueue_many', 'enqueue', 'enqueue_in', 'schedule', 'get_scheduled', 'cancel_scheduled',
+        'clear_queued', 'job_finished', 'get_queue_depth', 'acquire_lease', 'renew_lease', 'release_lease',
+        'get_state', 'update_state', 'increment_state', 'remove_state', 'delete_state',
+    )
+
+    def __init__(self):
+        super(QueueBackend, self).__init__()
+        self.pending = []
+        self.round_trips = 0
+
+        for name in self.ROUND_TRIP_METHODS:
+            setattr(self, name, self._counted(getattr(self, name)))
+
+    def _counted(self, method):
+        @functools.wraps(method)
+        def counted(*args, **kwargs):
+            self.round_trips += 1
+            return method(*args, **kwargs)
+        return counted
+
+    def _submit(self, job):
+        self.pending.append(job)
+        return job
+
+    def get_queue_depth(self, queue=None):
+        return len(self.pending)
+
+    def drain(self):
+        """Runs queued jobs, including any they queue, until none are left. Returns the number run."""
+        count = 0
+        while self.pending:
+            job = self.pending.pop(0)
+            _run_local_job(job.id, job.func, job.args, job.kwargs)
+            count += 1
+        return count
@@ -0,0 +1,67 @@
+"""
+A synthetic stream and time frame for the benchmarks.
+"""
+
+import datetime
+
+from django.db import models
+from stream_analysis import AbstractStream, BaseTimeFrame, StreamBatch
+
+
+class StreamItem(models.Model):
+    created_at = models.DateTimeField(db_index=True)
+    value = models.IntegerField(default=0)
+
+
+class SyntheticStream(AbstractStream):
+    """A stream of StreamItems."""
+
+    def is_stream_empty(self):
+        return not StreamItem.objects.exists()
+
+    def get_earliest_stream_time(self):
+        return StreamItem.objects.aggregate(earliest=models.Min('created_at'))['earliest']
+
+    def get_latest_stream_time(self):
+        return StreamItem.objects.aggregate(latest=models.Max('created_at'))['latest']
+
+    def get_stream_data(self, start, end):
+        return list(StreamItem.objects.filter(created_at__gte=start, created_at__lt=end))
+
+    def get_stream_columns(self, start, end, fields):
+        return StreamBatch.from_queryset(StreamItem.objects.filter(created_at__gte=start, created_at__lt=end),
+                                         fields, time_field='created_at')
+
+    def get_stream_item_time(self, item):
+        return item.created_at
+
+    def delete_before(self, cutoff_datetime):
+        query = StreamItem.objects.filter(created_at__lt=cutoff_datetime)
+        count = query.count()
+        query.delete()
+        return count
+
+    def delete_batch_before(self, cutoff_datetime, batch_size):
+        ids = list(StreamItem.objects.filter(created_at__lt=cutoff_datetime)
+                   .order_by('id').values_list('id', flat=True)[:batch_size])
+        StreamItem.objects.filter(id__in=ids).delete()
+        return len(ids)
+
+    def count_before(self, cutoff_datetime):
+        return StreamItem.objects.filter(created_at__lt=cutoff_datetime).count()
+
+
+class BenchTimeFrame(BaseTimeFrame):
+    DURATION = datetime.timedelta(minutes=1)
+    STREAM_CLASS = SyntheticStream
+
+    item_count = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+
+    def calculate(self, stream_data):
+        self.item_count = len(stream_data)
+        if isinstance(stream_data, StreamBatch):
+            # With --columns
+            self.total = sum(stream_data['value'])
+        else:
+            self.total = sum(item.value for item in stream_data)
@@ -0,0 +1,248 @@
+"""
+Measures the throughput of the create -> analyze -> backfill -> cleanup pipeline
+over a synthetic stream in SQLite, and writes the results as JSON.
+
+Run it from the top of the repository:
+
+    python -m benchmarks.run --minutes 120 --rate 50 --output results.json
+"""
+
+import datetime
+import json
+import optparse
+import platform
+import random
+import time
+
+from django.conf import settings
+
+TASK_KEY = 'bench'
+
+
+def configure(options):
+    settings.configure(
+        DEBUG=False,
+        USE_TZ=True,
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': options.database,
+            },
+        },
+        INSTALLED_APPS=(
+            'stream_analysis',
+            'benchmarks.bench_app',
+        ),
+        RQ_QUEUES={},
+        ANALYSIS_BACKEND='benchmarks.backend.QueueBackend',
+        ANALYSIS_AUTO_RELOAD=False,
+        ANALYSIS_TIME_FRAME_TASKS={
+            TASK_KEY: {
+                'name': 'Benchmark',
+                'frame_class_path': 'benchmarks.bench_app.models.BenchTimeFrame',
+                'batch_size': options.batch_size,
+            },
+        },
+    )
+
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def create_tables():
+    import django
+    from django.core.management import call_command
+
+    if django.VERSION >= (1, 9):
+        call_command('migrate', interactive=False, verbosity=0, run_syncdb=True)
+    elif django.VERSION >= (1, 7):
+        call_command('migrate', interactive=False, verbosity=0)
+    else:
+        call_command('syncdb', interactive=False, verbosity=0)
+
+
+def generate_stream(options, start):
+    """
+    Adds options.rate items per second of stream time on average,
+    for options.minutes. With skew > 0, most items arrive in bursts:
+    each minute's rate is drawn from a Pareto distribution with shape 1 / skew.
+    Returns the number of items added.
+    """
+    from django.db import transaction
+    from benchmarks.bench_app.models import StreamItem
+
+    rng = random.Random(options.seed)
+
+    count = 0
+    with transaction.atomic():
+        for minute in range(options.minutes):
+            minute_start = start + datetime.timedelta(minutes=minute)
+            rate = options.rate
+            if options.skew > 0:
+                shape = 1.0 / options.skew
+                # Scale so the mean stays at options.rate
+                rate *= rng.paretovariate(shape) * (shape - 1) / shape if shape > 1 else rng.paretovariate(shape)
+
+            items = [StreamItem(created_at=minute_start + datetime.timedelta(seconds=rng.random() * 60),
+                                value=rng.randint(0, 100))
+                     for _ in range(int(rate * 60))]
+            StreamItem.objects.bulk_create(items, batch_size=500)
+            count += len(items)
+
+    return count
+
+
+def get_peak_rss_kb():
+    from stream_analysis import profiling
+    return profiling.get_max_rss() // 1024
+
+
+class Phase(object):
+    """Measures the time, DB queries and backend round trips of a phase."""
+
+    def __init__(self, name):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from stream_analysis import backends
+
+        self.name = name
+        self.backend = backends.get_backend()
+        self.queries = CaptureQueriesContext(connection)
+
+    def __enter__(self):
+        self.queries.__enter__()
+        self.round_trips = self.backend.round_trips
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.time() - self.started
+        self.round_trips = self.backend.round_trips - self.round_trips
+        self.queries.__exit__(exc_type, exc_value, traceback)
+
+    def report(self, frames=0, rows=0, **extra):
+        def per(amount, count):
+            return amount / float(count) if count else None
+
+        result = {
+            'seconds': self.elapsed,
+            'frames': frames,
+            'rows': rows,
+            'frames_per_second': per(frames, self.elapsed),
+            'rows_per_second': per(rows, self.elapsed),
+            'db_queries': len(self.queries),
+            'db_queries_per_frame': per(len(self.queries), frames),
+            'round_trips': self.round_trips,
+            'round_trips_per_frame': per(self.round_trips, frames),
+        }
+        result.update(extra)
+        return result
+
+
+def _frame_totals():
+    from django.db.models import Count, Sum
+    from benchmarks.bench_app.models import BenchTimeFrame
+
+    totals = BenchTimeFrame.objects.filter(calculated=True) \
+        .aggregate(frames=Count('pk'), rows=Sum('item_count'))
+    return totals['frames'], totals['rows'] or 0
+
+
+def run(options):
+    from django.utils import timezone
+    from stream_analysis import backends, utils, watermarks
+    from benchmarks.bench_app.models import BenchTimeFrame, StreamItem
+
+    backend = backends.get_backend()
+    results = {}
+
+    if options.columns:
+        BenchTimeFrame.STREAM_COLUMNS = ('value',)
+
+    start = timezone.now().replace(second=0, microsecond=0) - datetime.timedelta(minutes=options.minutes)
+    generated = generate_stream(options, start)
+
+    # Create and analyze frames for the whole stream
+    with Phase('create') as phase:
+        utils.create_frames(TASK_KEY)
+    created = BenchTimeFrame.objects.count()
+    results['create'] = phase.report(frames=created, jobs=len(backend.pending))
+
+    with Phase('analyze') as phase:
+        jobs = backend.drain()
+    frames, rows = _frame_totals()
+    results['analyze'] = phase.report(frames=frames, rows=rows, jobs=jobs)
+
+    # Forget the older half of the frames, and fill them back in
+    midpoint = start + datetime.timedelta(minutes=options.minutes // 2)
+    BenchTimeFrame.objects.filter(start_time__lt=midpoint).delete()
+    watermarks.rebuild(BenchTimeFrame)
+    frames_before, rows_before = _frame_totals()
+
+    with Phase('backfill') as phase:
+        utils.backfill_tasks(TASK_KEY)
+        jobs = backend.drain()
+    frames, rows = _frame_totals()
+    results['backfill'] = phase.report(frames=frames - frames_before, rows=rows - rows_before, jobs=jobs)
+
+    # Delete the analyzed stream data
+    items_before = StreamItem.objects.count()
+    with Phase('cleanup') as phase:
+        deleted = utils.cleanup()
+    results['cleanup'] = phase.report(rows=deleted, items_left=items_before - deleted)
+
+    return {
+        'config': {
+            'minutes': options.minutes,
+            'rate': options.rate,
+            'skew': options.skew,
+            'batch_size': options.batch_size,
+            'columns': options.columns,
+            'seed': options.seed,
+            'stream_items': generated,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'django': __import__('django').get_version(),
+            'platform': platform.platform(),
+        },
+        'phases': results,
+        'peak_rss_kb': get_peak_rss_kb(),
+    }
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="python -m benchmarks.run [options]")
+    parser.add_option('--minutes', type='int', default=60,
+                      help='Minutes of synthetic stream data to generate.')
+    parser.add_option('--rate', type='float', default=20.0,
+                      help='Average stream items per second.')
+    parser.add_option('--skew', type='float', default=0.0,
+                      help='Burstiness of the stream, 0 for a steady rate.')
+    parser.add_option('--batch-size', type='int', default=1, dest='batch_size',
+                      help='Frames per analysis job.')
+    parser.add_option('--columns', action='store_true', default=False,
+                      help='Analyze frames with a StreamBatch of columns instead of model instances.')
+    parser.add_option('--seed', type='int', default=0,
+                      help='Random seed for the stream data.')
+    parser.add_option('--database', default=':memory:',
+                      help='SQLite database file.')
+    parser.add_option('--output', default=None,
+                      help='Write the JSON results to this file instead of stdout.')
+    options, args = parser.parse_args(argv)
+
+    configure(options)
+    create_tables()
+    results = run(options)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
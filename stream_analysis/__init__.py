@@ -19,9 +19,10 @@ if not logger.handlers:
     })
 
 
-from models import BaseTimeFrame, TimedIntervalMixin
+from models import BaseTimeFrame, PartitionedTimeFrame, TimedIntervalMixin
 from streams import AbstractStream
+from columns import StreamBatch
 from utils import AnalysisTask, cleanup, get_stream_cutoff_times
 
-__all__ = ['BaseTimeFrame', 'TimedIntervalMixin',
-           'AbstractStream', 'AnalysisTask', 'cleanup']
\ No newline at end of file
+__all__ = ['BaseTimeFrame', 'PartitionedTimeFrame', 'TimedIntervalMixin',
+           'AbstractStream', 'StreamBatch', 'AnalysisTask', 'cleanup']
\ No newline at end of file
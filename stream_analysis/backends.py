@@ -0,0 +1,692 @@
+"""
+Execution backends that run the analysis work.
+
+The "rq" backend (the default) runs jobs on RQ workers
+and repeats tasks with rq-scheduler.
+
+The "local" backend runs jobs inside the current process,
+on a concurrent.futures thread pool,
+and repeats tasks with a simple timer thread.
+It needs no Redis server or worker processes.
+"""
+
+import datetime
+import functools
+import json
+import logging
+import threading
+import time
+import uuid
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+from django.utils import importlib
+import settings
+import django_rq
+import times
+from rq import get_current_job
+from rq.job import Job, Status
+from rq.worker import DEFAULT_RESULT_TTL
+from redis import WatchError
+
+logger = logging.getLogger('stream_analysis')
+
+
+class BaseBackend(object):
+    """
+    The operations the analysis code needs from an execution backend.
+    """
+
+    def enqueue_many(self, calls, queue=None):
+        """
+        Creates a job for each (func, kwargs, meta) tuple in calls
+        and queues them for execution. Returns the jobs.
+        """
+        raise NotImplementedError
+
+    def enqueue(self, func, args=None, kwargs=None, meta=None, queue=None, timeout=None):
+        """Queues a single function call for execution. Returns the job."""
+        raise NotImplementedError
+
+    def enqueue_in(self, delay, func, kwargs=None, meta=None):
+        """Queues a function call for execution after delay seconds. Returns the job."""
+        raise NotImplementedError
+
+    def schedule(self, task_key, func, interval, kwargs):
+        """
+        Calls func with kwargs every interval seconds, starting now.
+        Returns the scheduled job.
+        """
+        raise NotImplementedError
+
+    def get_scheduled(self, task_key):
+        """Returns the scheduled job for the task, or None."""
+        raise NotImplementedError
+
+    def cancel_scheduled(self, task_key):
+        """Stops every scheduled job for the task. Returns True if there were any."""
+        raise NotImplementedError
+
+    def clear_queued(self, task_key):
+        """
+        Cancels the queued jobs for the task that have not started yet.
+        Returns the meta dicts of the cancelled jobs.
+        """
+        raise NotImplementedError
+
+    def job_finished(self):
+        """Called after each job function returns or fails."""
+        pass
+
+    def get_queue_depth(self, queue=None):
+        """Returns the number of jobs waiting on the queue."""
+        raise NotImplementedError
+
+    def get_current_job_id(self):
+        """Returns the id of the job running in this thread, or None."""
+        raise NotImplementedError
+
+    def acquire_lease(self, name, token, ttl):
+        """
+        Try to take the named lease for ttl seconds.
+        Returns True if the lease now belongs to token.
+        """
+        raise NotImplementedError
+
+    def renew_lease(self, name, token, ttl):
+        """
+        Extend the named lease to ttl seconds from now, if it still belongs to token.
+        Returns True if it was renewed.
+        """
+        raise NotImplementedError
+
+    def release_lease(self, name, token):
+        """Give up the named lease, if it still belongs to token."""
+        raise NotImplementedError
+
+    def get_state(self, name):
+        """Returns the named dict of saved state values, which may be empty."""
+        raise NotImplementedError
+
+    def update_state(self, name, values):
+        """Saves the values in the named state dict."""
+        raise NotImplementedError
+
+    def increment_state(self, name, amounts):
+        """Atomically adds the given amounts to integer values in the named state dict."""
+        raise NotImplementedError
+
+    def remove_state(self, name, keys):
+        """Removes the given keys from the named state dict."""
+        raise NotImplementedError
+
+    def delete_state(self, name):
+        """Forgets the named state dict."""
+        raise NotImplementedError
+
+
+class RQBackend(BaseBackend):
+    """
+    Runs analysis on RQ workers, scheduled by rq-scheduler.
+    """
+
+    LEASE_KEY_PREFIX = 'stream_analysis:lease:'
+    STATE_KEY_PREFIX = 'stream_analysis:state:'
+
+    # A hash per task of queued job id -> [queue name, job meta]
+    JOBS_KEY_PREFIX = 'stream_analysis:jobs:'
+
+    # A set per task of the ids of its scheduled jobs
+    SCHEDULES_KEY_PREFIX = 'stream_analysis:schedules:'
+
+    # A hash of the keys of the tasks whose jobs from before
+    # the indexes existed have been added to them
+    INDEXED_KEY = 'stream_analysis:indexed'
+
+    # Removes the given job ids from a queue in one pass over it,
+    # returning the ids that were found
+    REMOVE_JOBS_SCRIPT = """
+        local remove = {}
+        for i = 1, #ARGV do
+            remove[ARGV[i]] = true
+        end
+
+        local kept = {}
+        local removed = {}
+        for _, job_id in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+            if remove[job_id] then
+                table.insert(removed, job_id)
+            else
+                table.insert(kept, job_id)
+            end
+        end
+
+        if #removed > 0 then
+            redis.call('DEL', KEYS[1])
+            for i = 1, #kept, 1000 do
+                redis.call('RPUSH', KEYS[1], unpack(kept, i, math.min(i + 999, #kept)))
+            end
+        end
+        return removed
+    """
+
+    def __init__(self):
+        self._scheduler = None
+
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            self._scheduler = django_rq.get_scheduler()
+        return self._scheduler
+
+    def get_connection(self):
+        return django_rq.get_connection()
+
+    def get_queue(self, name=None):
+        return django_rq.get_queue(name or 'default')
+
+    def _index_job(self, pipeline, job, queue_name):
+        """Adds a job to its task's index of queued jobs."""
+        task_key = job.meta.get('analysis.task.key')
+        if task_key:
+            pipeline.hset(self.JOBS_KEY_PREFIX + task_key, job.id, json.dumps([queue_name, job.meta]))
+
+    def enqueue_many(self, calls, queue=None):
+        """
+        Creates a job for each (func, kwargs, meta) tuple in calls,
+        and enqueues all of them with a single Redis pipeline.
+        """
+        queue = self.get_queue(queue)
+
+        if not queue._async:
+            # Synchronous queues run jobs as soon as they are enqueued
+            return [queue.enqueue_call(func, kwargs=kwargs) for func, kwargs, meta in calls]
+
+        connection = queue.connection
+        pipeline = connection.pipeline()
+        pipeline.sadd(queue.redis_queues_keys, queue.key)
+
+        jobs = []
+        for func, kwargs, meta in calls:
+            job = Job.create(func, kwargs=kwargs, connection=connection,
+                             result_ttl=DEFAULT_RESULT_TTL, status=Status.QUEUED,
+                             timeout=queue._default_timeout or queue.DEFAULT_TIMEOUT)
+            job.origin = queue.name
+            job.enqueued_at = times.now()
+            job.meta.update(meta)
+            job.save(pipeline=pipeline)
+            self._index_job(pipeline, job, queue.name)
+            pipeline.rpush(queue.key, job.id)
+            jobs.append(job)
+
+        pipeline.execute()
+        return jobs
+
+    def _index_old_jobs(self, task_key):
+        """
+        The first time a task is looked up, adds its schedules and queued jobs
+        from before the indexes existed to them, by scanning every job once.
+        """
+        connection = self.get_connection()
+        if connection.hget(self.INDEXED_KEY, task_key):
+            return
+
+        pipeline = connection.pipeline()
+        for job in self.scheduler.get_jobs():
+            if job.meta.get('analysis.task.key') != task_key:
+                continue
+            if job.meta.get('analysis.task.schedule'):
+                pipeline.sadd(self.SCHEDULES_KEY_PREFIX + task_key, job.id)
+            else:
+                self._index_job(pipeline, job, self.scheduler.queue_name)
+
+        for queue_name in set(['default', settings.BACKFILL_QUEUE]):
+            for job in self.get_queue(queue_name).get_jobs():
+                # Scheduler jobs are put on the queue when they are due
+                if job.meta.get('analysis.task.key') == task_key and not job.meta.get('analysis.task.schedule'):
+                    self._index_job(pipeline, job, queue_name)
+
+        pipeline.hset(self.INDEXED_KEY, task_key, 1)
+        pipeline.execute()
+
+    def _save_meta(self, job, meta, queue_name=None):
+        """Saves the job's meta, indexing the job if it is waiting on queue_name."""
+        pipeline = self.get_connection().pipeline()
+        job.meta.update(meta)
+        job.save(pipeline=pipeline)
+        if queue_name:
+            self._index_job(pipeline, job, queue_name)
+        pipeline.execute()
+
+    def enqueue(self, func, args=None, kwargs=None, meta=None, queue=None, timeout=None):
+        queue = self.get_queue(queue)
+        job = queue.enqueue_call(func, args=args, kwargs=kwargs,
+                                 timeout=timeout, result_ttl=DEFAULT_RESULT_TTL)
+        if job is not None and meta:
+            # Synchronous queues have run the job already
+            self._save_meta(job, meta, queue.name if queue._async else None)
+        return job
+
+    def enqueue_in(self, delay, func, kwargs=None, meta=None):
+        job = self.scheduler.enqueue_in(datetime.timedelta(seconds=delay), func, **(kwargs or {}))
+        if meta:
+            # The scheduler moves the job onto its own queue when it is due
+            self._save_meta(job, meta, self.scheduler.queue_name)
+        return job
+
+    def schedule(self, task_key, func, interval, kwargs):
+        job = self.scheduler.schedule(
+            scheduled_time=datetime.datetime.now(),
+            interval=interval,
+            func=func,
+            kwargs=kwargs
+        )
+
+        pipeline = self.get_connection().pipeline()
+        job.meta['analysis.task.key'] = task_key
+        job.meta['analysis.task.schedule'] = True
+        job.save(pipeline=pipeline)
+        pipeline.sadd(self.SCHEDULES_KEY_PREFIX + task_key, job.id)
+        pipeline.execute()
+
+        return job
+
+    def get_scheduled(self, task_key):
+        self._index_old_jobs(task_key)
+        connection = self.get_connection()
+        for job_id in connection.smembers(self.SCHEDULES_KEY_PREFIX + task_key):
+            if connection.zscore(self.scheduler.scheduled_jobs_key, job_id) is not None:
+                return Job.fetch(job_id, connection=connection)
+
+    def cancel_scheduled(self, task_key):
+        # Several nodes may have scheduled the same task
+        self._index_old_jobs(task_key)
+        connection = self.get_connection()
+        schedules_key = self.SCHEDULES_KEY_PREFIX + task_key
+        job_ids = list(connection.smembers(schedules_key))
+        if not job_ids:
+            return False
+
+        pipeline = connection.pipeline()
+        for job_id in job_ids:
+            pipeline.zrem(self.scheduler.scheduled_jobs_key, job_id)
+            pipeline.delete(Job.key_for(job_id))
+        pipeline.srem(schedules_key, *job_ids)
+        results = pipeline.execute()
+
+        return any(results[0:-1:2])
+
+    def clear_queued(self, task_key):
+        self._index_old_jobs(task_key)
+        connection = self.get_connection()
+        jobs_key = self.JOBS_KEY_PREFIX + task_key
+        indexed = connection.hgetall(jobs_key)
+        if not indexed:
+            return []
+
+        metas = {}
+        job_ids_by_queue = {}
+        for job_id, value in indexed.iteritems():
+            queue_name, metas[job_id] = json.loads(value)
+            job_ids_by_queue.setdefault(queue_name, []).append(job_id)
+
+        # Take the jobs off their queues, and any delayed jobs off the scheduler
+        remove_jobs = connection.register_script(self.REMOVE_JOBS_SCRIPT)
+        removed = set()
+        for queue_name, job_ids in job_ids_by_queue.iteritems():
+            removed.update(remove_jobs(keys=[self.get_queue(queue_name).key], args=job_ids))
+
+        pipeline = connection.pipeline()
+        for job_id in indexed:
+            pipeline.zrem(self.scheduler.scheduled_jobs_key, job_id)
+        for job_id, was_scheduled in zip(indexed, pipeline.execute()):
+            if was_scheduled:
+                removed.add(job_id)
+
+        # Jobs that were not found are running or finished already
+        pipeline = connection.pipeline()
+        for job_id in removed:
+            pipeline.delete(Job.key_for(job_id))
+        pipeline.hdel(jobs_key, *indexed.keys())
+        pipeline.execute()
+
+        return [metas[job_id] for job_id in removed]
+
+    def job_finished(self):
+        job = get_current_job()
+        if job is not None and job.meta.get('analysis.task.key'):
+            self.get_connection().hdel(self.JOBS_KEY_PREFIX + job.meta['analysis.task.key'], job.id)
+
+    def get_queue_depth(self, queue=None):
+        return self.get_queue(queue).count
+
+    def get_current_job_id(self):
+        job = get_current_job()
+        return job.id if job else None
+
+    def acquire_lease(self, name, token, ttl):
+        ttl = max(1, int(ttl))
+        return bool(self.get_connection().set(self.LEASE_KEY_PREFIX + name, token, nx=True, ex=ttl))
+
+    def renew_lease(self, name, token, ttl):
+        key = self.LEASE_KEY_PREFIX + name
+        with self.get_connection().pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != token:
+                    return False
+                pipe.multi()
+                pipe.expire(key, max(1, int(ttl)))
+                pipe.execute()
+                return True
+            except WatchError:
+                # Somebody else took it over in the meantime
+                return False
+
+    def release_lease(self, name, token):
+        key = self.LEASE_KEY_PREFIX + name
+        with self.get_connection().pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) == token:
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.execute()
+            except WatchError:
+                # Somebody else took it over in the meantime
+                pass
+
+    def get_state(self, name):
+        return self.get_connection().hgetall(self.STATE_KEY_PREFIX + name)
+
+    def update_state(self, name, values):
+        if values:
+            self.get_connection().hmset(self.STATE_KEY_PREFIX + name, values)
+
+    def increment_state(self, name, amounts):
+        pipeline = self.get_connection().pipeline()
+        for key, amount in amounts.iteritems():
+            pipeline.hincrby(self.STATE_KEY_PREFIX + name, key, amount)
+        pipeline.execute()
+
+    def remove_state(self, name, keys):
+        if keys:
+            self.get_connection().hdel(self.STATE_KEY_PREFIX + name, *keys)
+
+    def delete_state(self, name):
+        self.get_connection().delete(self.STATE_KEY_PREFIX + name)
+
+
+# The id of the local job running in each thread
+_local_job = threading.local()
+
+
+def _run_local_job(job_id, func, args, kwargs):
+    """Runs a local backend job."""
+    _local_job.id = job_id
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        logger.error("Local job %s failed", job_id, exc_info=True)
+        raise
+    finally:
+        _local_job.id = None
+        close_old_connections()
+
+
+class LocalJob(object):
+    """A job queued on the local backend."""
+
+    def __init__(self, func, args, kwargs, meta):
+        self.id = str(uuid.uuid4())
+        self.func = func
+        self.args = args or ()
+        self.kwargs = kwargs or {}
+        self.meta = dict(meta or {})
+        self.future = None
+
+    def cancel(self):
+        """Cancels the job if it has not started. Returns True if it was cancelled."""
+        return self.future is not None and self.future.cancel()
+
+
+class LocalBackend(BaseBackend):
+    """
+    Runs analysis in this process, on a thread pool.
+    Jobs queue further jobs, and share leases and state, in the
+    memory of this process, so process pools are not supported.
+
+    With ANALYSIS_LOCAL_WORKERS = 0, jobs run immediately
+    in the calling thread, which is convenient for tests.
+    """
+
+    def __init__(self):
+        self.workers = settings.LOCAL_WORKERS
+
+        self._lock = threading.RLock()
+        self._executor = None
+        self._queued = {}
+        self._schedules = {}
+        self._leases = {}
+        self._state = {}
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                try:
+                    from concurrent import futures
+                except ImportError:
+                    raise ImproperlyConfigured("The local analysis backend requires the 'futures' package.")
+
+                self._executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _submit(self, job):
+        if not self.workers:
+            _run_local_job(job.id, job.func, job.args, job.kwargs)
+            return job
+
+        with self._lock:
+            self._queued[job.id] = job
+            job.future = self.executor.submit(_run_local_job, job.id, job.func, job.args, job.kwargs)
+
+        job.future.add_done_callback(functools.partial(self._finished, job.id))
+        return job
+
+    def _finished(self, job_id, future):
+        with self._lock:
+            self._queued.pop(job_id, None)
+
+    def enqueue_many(self, calls, queue=None):
+        return [self._submit(LocalJob(func, None, kwargs, meta)) for func, kwargs, meta in calls]
+
+    def enqueue(self, func, args=None, kwargs=None, meta=None, queue=None, timeout=None):
+        return self._submit(LocalJob(func, args, kwargs, meta))
+
+    def enqueue_in(self, delay, func, kwargs=None, meta=None):
+        job = LocalJob(func, None, kwargs, meta)
+        timer = threading.Timer(delay, self._submit, args=(job,))
+        timer.daemon = True
+        timer.start()
+        return job
+
+    def schedule(self, task_key, func, interval, kwargs):
+        job = LocalJob(func, None, kwargs, {
+            'analysis.task.key': task_key,
+            'analysis.task.schedule': True,
+        })
+        job.stopped = threading.Event()
+
+        def repeat():
+            while not job.stopped.is_set():
+                self.enqueue(func, kwargs=kwargs, meta={'analysis.task.key': task_key})
+                job.stopped.wait(interval)
+
+        thread = threading.Thread(target=repeat, name='stream_analysis-%s' % task_key)
+        thread.daemon = True
+
+        with self._lock:
+            self._schedules[task_key] = job
+        thread.start()
+
+        return job
+
+    def get_scheduled(self, task_key):
+        with self._lock:
+            return self._schedules.get(task_key)
+
+    def cancel_scheduled(self, task_key):
+        with self._lock:
+            job = self._schedules.pop(task_key, None)
+
+        if job:
+            job.stopped.set()
+            return True
+
+        return False
+
+    def clear_queued(self, task_key):
+        with self._lock:
+            jobs = [job for job in self._queued.values()
+                    if job.meta.get('analysis.task.key') == task_key]
+
+        return [job.meta for job in jobs if job.cancel()]
+
+    def get_queue_depth(self, queue=None):
+        # All jobs share one pool, whatever queue they were put on
+        with self._lock:
+            return sum(1 for job in self._queued.values() if not job.future.running())
+
+    def get_current_job_id(self):
+        return getattr(_local_job, 'id', None)
+
+    def acquire_lease(self, name, token, ttl):
+        now = time.time()
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder and holder[1] > now:
+                return False
+            self._leases[name] = (token, now + max(1, int(ttl)))
+            return True
+
+    def renew_lease(self, name, token, ttl):
+        now = time.time()
+        with self._lock:
+            holder = self._leases.get(name)
+            if not holder or holder[0] != token or holder[1] <= now:
+                return False
+            self._leases[name] = (token, now + max(1, int(ttl)))
+            return True
+
+    def release_lease(self, name, token):
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder and holder[0] == token:
+                del self._leases[name]
+
+    def get_state(self, name):
+        with self._lock:
+            return dict(self._state.get(name, {}))
+
+    def update_state(self, name, values):
+        with self._lock:
+            # Store strings, as Redis would
+            self._state.setdefault(name, {}).update((key, str(value)) for key, value in values.iteritems())
+
+    def increment_state(self, name, amounts):
+        with self._lock:
+            state = self._state.setdefault(name, {})
+            for key, amount in amounts.iteritems():
+                state[key] = str(int(state.get(key, 0)) + amount)
+
+    def remove_state(self, name, keys):
+        with self._lock:
+            state = self._state.get(name, {})
+            for key in keys:
+                state.pop(key, None)
+
+    def delete_state(self, name):
+        with self._lock:
+            self._state.pop(name, None)
+
+
+class LeaseKeeper(object):
+    """
+    A context manager that renews a lease held with the given token
+    every ttl / 3 seconds on a background thread, until it exits.
+    It does not release the lease, which expires ttl seconds later.
+    """
+
+    def __init__(self, name, token, ttl):
+        self.name = name
+        self.token = token
+        self.ttl = ttl
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.ttl / 3.0):
+            try:
+                if not get_backend().renew_lease(self.name, self.token, self.ttl):
+                    logger.warn("Lost the lease %s", self.name)
+                    return
+            except Exception:
+                logger.warn("Renewing the lease %s failed", self.name, exc_info=True)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name='stream_analysis-lease')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._thread.join()
+
+
+BACKENDS = {
+    'rq': RQBackend,
+    'local': LocalBackend,
+}
+
+_backend = None
+
+
+def get_backend():
+    """Returns the backend chosen by the ANALYSIS_BACKEND setting."""
+    global _backend
+    if _backend is None:
+        backend_class = BACKENDS.get(settings.BACKEND)
+        if backend_class is None:
+            # Otherwise, a dotted path to a backend class
+            try:
+                module_name, attribute = settings.BACKEND.rsplit('.', 1)
+                backend_class = getattr(importlib.import_module(module_name), attribute)
+            except (ValueError, ImportError, AttributeError):
+                raise ImproperlyConfigured("Unknown ANALYSIS_BACKEND %s" % settings.BACKEND)
+        _backend = backend_class()
+    return _backend
+
+
+def job(func=None, timeout=None):
+    """
+    Marks a function as an analysis job, adding a delay()
+    method that queues a call to it on the current backend.
+    Use as @job or @job(timeout=seconds).
+    """
+    if func is None:
+        return functools.partial(job, timeout=timeout)
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            get_backend().job_finished()
+
+    def delay(*args, **kwargs):
+        return get_backend().enqueue(run, args=args, kwargs=kwargs, timeout=timeout)
+
+    run.delay = delay
+    return run
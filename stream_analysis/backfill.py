@@ -0,0 +1,181 @@
+"""
+Backfilling creates the missing frames for stream data older than
+a task's oldest frame, walking backwards through history one chunk at a time.
+
+Progress is saved in the backend state store after every chunk,
+so an interrupted backfill resumes where it stopped.
+The analysis jobs go on their own queue (ANALYSIS_BACKFILL_QUEUE),
+so that live analysis is not starved, and frames are created
+no faster than a frames-per-second cap (ANALYSIS_BACKFILL_RATE).
+"""
+
+import datetime
+import logging
+import time
+
+from django.db.models import Min
+from django.utils.dateparse import parse_datetime
+import backends
+import settings
+import utils
+
+logger = logging.getLogger('stream_analysis')
+
+
+class Backfill(object):
+    """
+    The backfill of a single analysis task.
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.frame_class = task.get_frame_class()
+        self.state_name = 'backfill:%s' % task.key
+
+    def get_progress(self):
+        """
+        Returns a dict describing the backfill in progress, or None. It has:
+            cursor: start of the earliest frame created so far
+            target: frames will be created back to just after this time
+            created: the number of frames created so far
+            remaining: the number of frames still to create
+        """
+        state = backends.get_backend().get_state(self.state_name)
+        if not state:
+            return None
+
+        cursor = parse_datetime(state['cursor'])
+        target = parse_datetime(state['target'])
+        return {
+            'cursor': cursor,
+            'target': target,
+            'created': int(state['created']),
+            'remaining': self._count_frames(cursor, target),
+        }
+
+    def _count_frames(self, cursor, target):
+        duration = self.frame_class.DURATION.total_seconds()
+        intervals = max(0, int((cursor - target).total_seconds() // duration))
+        return intervals * len(self.frame_class.make_frames(cursor))
+
+    def _save_progress(self, cursor, target, created):
+        backends.get_backend().update_state(self.state_name, {
+            'cursor': cursor.isoformat(),
+            'target': target.isoformat(),
+            'created': created,
+        })
+
+    def reset(self):
+        """Forgets the progress of this backfill."""
+        backends.get_backend().delete_state(self.state_name)
+
+    def start(self):
+        """
+        Works out the range of time to backfill, unless
+        a backfill is already in progress. Returns the progress,
+        or None if there is nothing to backfill.
+        """
+        progress = self.get_progress()
+        if progress:
+            return progress
+
+        stream = self.frame_class.STREAM_CLASS()
+        if self.frame_class.is_rollup() or stream.is_stream_empty():
+            logger.info("No data to backfill")
+            return None
+
+        # Get the oldest time frame.
+        # We'll start there and work backwards.
+        earliest_frame = self.frame_class.get_earliest_start_time()
+        if earliest_frame is None:
+            logger.info("No backfilling necessary.")
+            return None
+
+        # Get the oldest stream data.
+        # We'll stop once the frames cover it.
+        earliest_stream = stream.get_earliest_stream_time()
+        if earliest_stream is None:
+            logger.info("No data to backfill")
+            return None
+
+        target = earliest_stream - self.frame_class.DURATION
+        if earliest_frame - self.frame_class.DURATION <= target:
+            logger.info("No backfilling necessary.")
+            return None
+
+        logger.info("Backfilling %s from %s back to %s", self.task.name, earliest_frame, target)
+        self._save_progress(earliest_frame, target, 0)
+        return self.get_progress()
+
+    def run_chunk(self, chunk_size):
+        """
+        Creates and queues up to chunk_size more frames.
+        Returns the number of frames created, 0 once the backfill is done.
+        """
+        progress = self.start()
+        if not progress:
+            return 0
+
+        duration = self.frame_class.DURATION
+        target = progress['target']
+
+        # If the last chunk was inserted but its progress was not saved,
+        # carry on from its earliest frame instead of inserting it again
+        cursor = self.frame_class.objects \
+            .filter(start_time__gt=target, start_time__lt=progress['cursor']) \
+            .aggregate(earliest=Min('start_time'))['earliest'] or progress['cursor']
+
+        new_time_frames = []
+        frame_start = cursor - duration
+        while frame_start > target and len(new_time_frames) < chunk_size:
+            new_time_frames.extend(self.frame_class.make_frames(frame_start))
+            frame_start -= duration
+
+        if not new_time_frames:
+            logger.info("Finished backfilling %s", self.task.name)
+            self.reset()
+            return 0
+
+        utils._insert_and_queue(self.task, new_time_frames, queue=settings.BACKFILL_QUEUE)
+        self._save_progress(new_time_frames[-1].start_time, target,
+                            progress['created'] + len(new_time_frames))
+        return len(new_time_frames)
+
+    def run(self, max_rate=None, chunk_size=None, report=None):
+        """
+        Backfills until done, creating no more than max_rate frames per second
+        (ANALYSIS_BACKFILL_RATE by default, None for no limit).
+
+        After each chunk, calls report(progress, eta) if given, where eta
+        is a timedelta estimate of the time remaining, or None.
+        Returns the number of frames created.
+        """
+        if max_rate is None:
+            max_rate = settings.BACKFILL_RATE
+        chunk_size = chunk_size or settings.BACKFILL_CHUNK_SIZE
+        if max_rate:
+            # Small enough chunks that the rate is smooth
+            chunk_size = max(1, min(chunk_size, int(max_rate)))
+
+        started = time.time()
+        created = 0
+        while True:
+            count = self.run_chunk(chunk_size)
+            if not count:
+                break
+            created += count
+
+            if max_rate:
+                pause = created / float(max_rate) - (time.time() - started)
+                if pause > 0:
+                    time.sleep(pause)
+
+            if report:
+                progress = self.get_progress()
+                elapsed = time.time() - started
+                eta = None
+                if progress and elapsed > 0:
+                    eta = datetime.timedelta(seconds=int(progress['remaining'] * elapsed / created))
+                report(progress, eta)
+
+        return created
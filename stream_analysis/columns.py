@@ -0,0 +1,185 @@
+"""
+Columnar stream data, for time frames that analyze
+whole columns at once instead of one stream item at a time.
+
+Rows are streamed straight from values_list() into compact arrays,
+without creating a model instance for each stream item.
+"""
+
+import bisect
+import datetime
+from array import array
+
+from django.utils import timezone
+
+try:
+    from django.core.exceptions import FieldDoesNotExist
+except ImportError:
+    # Django < 1.8
+    from django.db.models.fields import FieldDoesNotExist
+
+from series import _epoch_seconds
+
+NAN = float('nan')
+
+# The array typecode for each kind of model field kept in a typed array.
+# Other fields, and nullable integer and boolean fields, are kept in lists.
+TYPECODES = {
+    'AutoField': 'l',
+    'BigAutoField': 'l',
+    'IntegerField': 'l',
+    'BigIntegerField': 'l',
+    'SmallIntegerField': 'l',
+    'PositiveIntegerField': 'l',
+    'PositiveSmallIntegerField': 'l',
+    'BooleanField': 'b',
+    'FloatField': 'd',
+    'DateTimeField': 'd',
+}
+
+
+class Row(object):
+    """A view of one item in a StreamBatch, with its fields as attributes."""
+
+    __slots__ = ('_index',)
+
+    def __init__(self, index):
+        self._index = index
+
+    def __repr__(self):
+        return '<%s #%d>' % (type(self).__name__, self._index)
+
+
+def _make_row_class(columns):
+    """Makes a Row class with a read-only property for each column."""
+    attributes = {'__slots__': ()}
+    for field, column in columns.iteritems():
+        attributes[field] = property(lambda row, column=column: column[row._index])
+    return type('Row', (Row,), attributes)
+
+
+class StreamBatch(object):
+    """
+    Stream items as columns: a typed array for each numeric, boolean
+    or datetime field, and a list for any other field.
+    Datetimes are in seconds since the epoch (UTC), and missing
+    floats and datetimes are NaN.
+
+    batch['value'] is a column, and iterating over the batch
+    gives a Row view of each item, so row.value works as well.
+    If the batch has a time_field, the items are in time order
+    and the batch can be split into time frames with between().
+    """
+
+    def __init__(self, fields, columns, time_field=None, datetime_fields=()):
+        self.fields = list(fields)
+        self.columns = columns
+        self.time_field = time_field
+        self.datetime_fields = set(datetime_fields)
+        self._row_class = _make_row_class(columns)
+
+    def __len__(self):
+        if not self.fields:
+            return 0
+        return len(self.columns[self.fields[0]])
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def __iter__(self):
+        row_class = self._row_class
+        for index in xrange(len(self)):
+            yield row_class(index)
+
+    def row(self, index):
+        """Returns a Row view of the item at index."""
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._row_class(index)
+
+    def slice(self, start, stop):
+        """Returns a new batch with the items from index start up to stop."""
+        columns = dict((field, column[start:stop]) for field, column in self.columns.iteritems())
+        return StreamBatch(self.fields, columns, self.time_field, self.datetime_fields)
+
+    def between(self, start, end):
+        """Returns a new batch with the items from start datetime up to end datetime."""
+        if self.time_field is None:
+            raise ValueError("The batch has no time field")
+
+        times = self.columns[self.time_field]
+        return self.slice(bisect.bisect_left(times, _epoch_seconds(start)),
+                          bisect.bisect_left(times, _epoch_seconds(end)))
+
+    def get_datetimes(self, field):
+        """Returns a datetime column as a list of UTC datetimes."""
+        return [None if value != value else
+                datetime.datetime.utcfromtimestamp(value).replace(tzinfo=timezone.utc)
+                for value in self.columns[field]]
+
+    def to_numpy(self):
+        """
+        Returns a dict of NumPy arrays, sharing memory with the typed arrays:
+        datetime fields as datetime64, and list columns as object arrays.
+        Requires NumPy.
+        """
+        import numpy
+
+        result = {}
+        for field in self.fields:
+            column = self.columns[field]
+            if not isinstance(column, array):
+                result[field] = numpy.array(column, dtype=object)
+                continue
+
+            dtype = numpy.bool_ if column.typecode == 'b' else column.typecode
+            values = numpy.frombuffer(column, dtype=dtype) if len(column) else numpy.zeros(0, dtype=dtype)
+            if field in self.datetime_fields:
+                values = (values * 1e6).astype('datetime64[us]')
+            result[field] = values
+        return result
+
+    @classmethod
+    def from_queryset(cls, queryset, fields, time_field=None):
+        """
+        Reads the fields of a queryset into a batch with values_list().
+        If time_field is given, it is included and the items are ordered by it.
+        """
+        fields = list(fields)
+        if time_field is not None:
+            if time_field not in fields:
+                fields.append(time_field)
+            queryset = queryset.order_by(time_field)
+
+        columns = {}
+        converters = []
+        datetime_fields = []
+        for field in fields:
+            try:
+                model_field = queryset.model._meta.get_field(field)
+            except FieldDoesNotExist:
+                # Related lookups and the like
+                model_field = None
+
+            internal_type = model_field.get_internal_type() if model_field is not None else None
+            typecode = TYPECODES.get(internal_type)
+            if typecode is None or (model_field.null and typecode != 'd'):
+                columns[field] = []
+                converters.append(None)
+            elif internal_type == 'DateTimeField':
+                columns[field] = array('d')
+                converters.append(lambda value: NAN if value is None else _epoch_seconds(value))
+                datetime_fields.append(field)
+            elif typecode == 'd':
+                columns[field] = array('d')
+                converters.append(lambda value: NAN if value is None else value)
+            else:
+                columns[field] = array(typecode)
+                converters.append(None)
+
+        appenders = [(columns[field].append, convert) for field, convert in zip(fields, converters)]
+        for row in queryset.values_list(*fields).iterator():
+            for (append, convert), value in zip(appenders, row):
+                append(convert(value) if convert is not None else value)
+
+        return cls(fields, columns, time_field, datetime_fields)
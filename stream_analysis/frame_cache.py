@@ -0,0 +1,218 @@
+"""
+A read-through cache of calculated frames.
+
+Frames are cached in buckets of ANALYSIS_FRAME_CACHE_BUCKET seconds
+of stream time, aligned to the epoch, either in a Django cache
+(ANALYSIS_FRAME_CACHE = "<cache alias>") or in an LRU cache in the
+memory of each process (ANALYSIS_FRAME_CACHE = "local").
+
+Each bucket has a generation, kept in the backend state store so that
+every process sees it. Whenever a frame is calculated, the generation of
+its bucket is bumped, so only that bucket is read from the database again.
+
+Buckets are cached for ANALYSIS_FRAME_CACHE_TIMEOUT seconds. A generation
+is the time it was bumped along with a random token, so it never repeats,
+and generations that are older than the timeout are dropped, as nothing
+can still be cached under them.
+"""
+
+import calendar
+import collections
+import datetime
+import random
+import threading
+import time
+
+from django.conf import settings as django_settings
+from django.utils import timezone
+import backends
+import settings
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class LRUCache(object):
+    """A small thread-safe least-recently-used cache with a get_many/set_many interface."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    expires, value = self._entries.pop(key)
+                    if expires is not None and expires <= now:
+                        continue
+                    # Move to the most recently used end
+                    self._entries[key] = (expires, value)
+                    found[key] = value
+        return found
+
+    def set_many(self, values, timeout=None):
+        expires = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            for key, value in values.iteritems():
+                self._entries.pop(key, None)
+                self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _get_django_cache(alias):
+    try:
+        from django.core.cache import caches
+        return caches[alias]
+    except ImportError:
+        # Django < 1.7
+        from django.core.cache import get_cache
+        return get_cache(alias)
+
+
+def is_enabled():
+    return bool(settings.FRAME_CACHE)
+
+
+def get_store():
+    """Returns the cache the buckets are kept in."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if settings.FRAME_CACHE == 'local':
+                _store = LRUCache(settings.FRAME_CACHE_SIZE)
+            else:
+                _store = _get_django_cache(settings.FRAME_CACHE)
+        return _store
+
+
+# When each process last dropped old generations, by table
+_last_pruned = {}
+
+
+def _state_name(frame_class):
+    return 'frame_cache:%s' % frame_class._meta.db_table
+
+
+def _new_generation():
+    return '%r:%x' % (time.time(), random.getrandbits(32))
+
+
+def _bucket_start(frame_class, value):
+    """The epoch seconds of the start of the bucket containing a datetime."""
+    if timezone.is_aware(value):
+        value = value.astimezone(timezone.utc)
+    seconds = calendar.timegm(value.timetuple())
+    bucket_seconds = _bucket_seconds(frame_class)
+    return seconds - seconds % bucket_seconds
+
+
+def _bucket_seconds(frame_class):
+    # Buckets hold at least one frame
+    return max(settings.FRAME_CACHE_BUCKET, int(frame_class.DURATION.total_seconds()))
+
+
+def _bucket_datetime(bucket):
+    value = datetime.datetime.utcfromtimestamp(bucket)
+    if django_settings.USE_TZ:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _cache_key(frame_class, state, bucket):
+    return 'stream_analysis:frames:%s:%s:%d:%s' % (frame_class._meta.db_table, state.get('epoch', '0'),
+                                                    bucket, state.get(str(bucket), '0'))
+
+
+def get_frames(frame_class, start, end):
+    """
+    Returns a list of the calculated frames overlapping start and end,
+    in start time order, like get_in_range(start, end, calculated=True).
+    Frames are read from the cache where possible.
+    """
+    if not is_enabled():
+        return list(frame_class.get_in_range(start=start, end=end, calculated=True).order_by('start_time'))
+
+    bucket_seconds = _bucket_seconds(frame_class)
+    first_bucket = _bucket_start(frame_class, start - frame_class.DURATION)
+    last_bucket = _bucket_start(frame_class, end)
+    buckets = range(first_bucket, last_bucket + bucket_seconds, bucket_seconds)
+
+    state = backends.get_backend().get_state(_state_name(frame_class))
+    keys = dict((bucket, _cache_key(frame_class, state, bucket)) for bucket in buckets)
+
+    store = get_store()
+    cached = store.get_many(keys.values())
+
+    frames_by_bucket = {}
+    missing = []
+    for bucket in buckets:
+        if keys[bucket] in cached:
+            frames_by_bucket[bucket] = cached[keys[bucket]]
+        else:
+            missing.append(bucket)
+
+    if missing:
+        # Read all of the missing buckets with a single query
+        missing_frames = dict((bucket, []) for bucket in missing)
+
+        frames = frame_class.objects \
+            .filter(calculated=True,
+                    start_time__gte=_bucket_datetime(missing[0]),
+                    start_time__lt=_bucket_datetime(missing[-1] + bucket_seconds)) \
+            .order_by('start_time')
+        for frame in frames:
+            bucket_frames = missing_frames.get(_bucket_start(frame_class, frame.start_time))
+            if bucket_frames is not None:
+                bucket_frames.append(frame)
+
+        store.set_many(dict((keys[bucket], missing_frames[bucket]) for bucket in missing),
+                       settings.FRAME_CACHE_TIMEOUT)
+        frames_by_bucket.update(missing_frames)
+
+    earliest_start = start - frame_class.DURATION
+    return [frame for bucket in buckets for frame in frames_by_bucket[bucket]
+            if earliest_start < frame.start_time < end]
+
+
+def frame_changed(frame):
+    """Invalidates the cached bucket containing the frame."""
+    if not is_enabled():
+        return
+
+    frame_class = type(frame)
+    bucket = _bucket_start(frame_class, frame.start_time)
+    backends.get_backend().update_state(_state_name(frame_class), {str(bucket): _new_generation()})
+
+    timeout = settings.FRAME_CACHE_TIMEOUT
+    now = time.time()
+    if timeout is not None and now - _last_pruned.get(frame_class._meta.db_table, 0) > timeout:
+        _last_pruned[frame_class._meta.db_table] = now
+        _prune(frame_class, now - timeout)
+
+
+def _prune(frame_class, before):
+    """Drops the generations of buckets last bumped before the given time."""
+    backend = backends.get_backend()
+    state = backend.get_state(_state_name(frame_class))
+    old = [bucket for bucket, generation in state.iteritems()
+           if bucket != 'epoch' and float(generation.split(':')[0]) < before]
+    backend.remove_state(_state_name(frame_class), old)
+
+
+def clear(frame_class):
+    """Invalidates every cached bucket for the frame class."""
+    backend = backends.get_backend()
+    buckets = [bucket for bucket in backend.get_state(_state_name(frame_class)) if bucket != 'epoch']
+
+    # Nothing is cached under the new epoch yet, so its buckets can start over
+    backend.update_state(_state_name(frame_class), {'epoch': _new_generation()})
+    backend.remove_state(_state_name(frame_class), buckets)
@@ -0,0 +1,119 @@
+"""
+Tracks the frames that are being analyzed, so that frames
+abandoned by a worker that died can be found and retried.
+
+While a job analyzes frames, a heartbeat thread keeps pushing back
+each frame's deadline in the backend state store. If the worker dies,
+the deadlines pass, and create_frames hands the frames to another job,
+up to the task's max_retries times. After that they are dead.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import backends
+
+logger = logging.getLogger('stream_analysis')
+
+
+def _deadlines_name(frame_class):
+    return 'inflight:%s' % frame_class._meta.db_table
+
+
+def _retries_name(frame_class):
+    return 'retries:%s' % frame_class._meta.db_table
+
+
+def _dead_name(frame_class):
+    return 'dead:%s' % frame_class._meta.db_table
+
+
+class Heartbeat(object):
+    """
+    A context manager that keeps the deadlines of the given frames
+    lease_ttl seconds in the future, until it exits.
+    Frames still not calculated at exit, or all of the frames if
+    it exits with an error, keep their last deadline, so they are
+    retried once it passes.
+    """
+
+    def __init__(self, frames, lease_ttl):
+        self.frames_by_class = collections.defaultdict(list)
+        for frame in frames:
+            self.frames_by_class[type(frame)].append(frame)
+        self.lease_ttl = lease_ttl
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def beat(self):
+        backend = backends.get_backend()
+        deadline = time.time() + self.lease_ttl
+        for frame_class, frames in self.frames_by_class.iteritems():
+            backend.update_state(_deadlines_name(frame_class),
+                                 dict((str(frame.pk), deadline) for frame in frames))
+
+    def _run(self):
+        while not self._stopped.wait(self.lease_ttl / 3.0):
+            try:
+                self.beat()
+            except Exception:
+                logger.warn("Heartbeat failed", exc_info=True)
+
+    def __enter__(self):
+        self.beat()
+        self._thread = threading.Thread(target=self._run, name='stream_analysis-heartbeat')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._thread.join()
+
+        if exc_type is not None:
+            # A rolled back transaction may have undone frames that look calculated
+            return
+
+        backend = backends.get_backend()
+        for frame_class, frames in self.frames_by_class.iteritems():
+            done = [str(frame.pk) for frame in frames if frame.calculated]
+            backend.remove_state(_deadlines_name(frame_class), done)
+            backend.remove_state(_retries_name(frame_class), done)
+
+
+def get_expired(frame_class):
+    """Returns the ids of the frames whose deadline has passed."""
+    now = time.time()
+    deadlines = backends.get_backend().get_state(_deadlines_name(frame_class))
+    return [frame_id for frame_id, deadline in deadlines.iteritems() if float(deadline) < now]
+
+
+def forget(frame_class, frame_ids):
+    """Stops tracking the deadlines of the frames."""
+    backends.get_backend().remove_state(_deadlines_name(frame_class), frame_ids)
+
+
+def add_retry(frame_class, frame_id):
+    """Counts another attempt at the frame. Returns the number of retries so far."""
+    backend = backends.get_backend()
+    backend.increment_state(_retries_name(frame_class), {frame_id: 1})
+    return int(backend.get_state(_retries_name(frame_class)).get(frame_id, 1))
+
+
+def mark_dead(frame_class, frame_id, start_time):
+    """Gives up on the frame."""
+    backend = backends.get_backend()
+    backend.update_state(_dead_name(frame_class), {frame_id: start_time.isoformat()})
+    backend.remove_state(_retries_name(frame_class), [frame_id])
+
+
+def get_dead(frame_class):
+    """Returns a dict of the ids of dead frames -> their start times, as ISO strings."""
+    return backends.get_backend().get_state(_dead_name(frame_class))
+
+
+def forget_dead(frame_class, frame_ids):
+    """Stops treating the frames as dead."""
+    backends.get_backend().remove_state(_dead_name(frame_class), frame_ids)
@@ -3,11 +3,11 @@ from stream_analysis.utils import AnalysisTask
 
 class Command(BaseCommand):
     """
-    Starts or stops a stream analysis task.
+    Starts or stops a stream analysis task, or shows its status.
     """
 
-    help = "Starts or stops a stream analysis task."
-    args = "<start|stop> <task_key>"
+    help = "Starts or stops a stream analysis task, or shows its status."
+    args = "<start|stop|status> <task_key>"
     def handle(self, cmd, task_key, *args, **options):
 
         task = AnalysisTask.get(key=task_key)
@@ -22,3 +22,7 @@ class Command(BaseCommand):
         elif cmd == 'stop':
             task.cancel()
             print "%s stopped." % task.name
+        elif cmd == 'status':
+            status = task.get_status()
+            lag = "unknown" if status['lag'] is None else "%d seconds" % status['lag']
+            print "%s: %s mode, lag %s, %d queued jobs" % (task.name, status['mode'], lag, status['queue_depth'])
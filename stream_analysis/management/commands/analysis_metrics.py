@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from stream_analysis import metrics
+from stream_analysis.utils import AnalysisTask
+
+class Command(BaseCommand):
+    """
+    Prints the metrics for the given analysis task, or for all.
+    """
+
+    args = "<task_key>"
+    help = "Prints analysis metrics in the Prometheus text format."
+
+    def handle(self, task_key=None, *args, **options):
+
+        if task_key:
+            task = AnalysisTask.get(key=task_key)
+            if not task:
+                print "No analysis task matching key %s" % task_key
+                return
+            tasks = [task]
+        else:
+            tasks = AnalysisTask.get()
+
+        print metrics.render(tasks),
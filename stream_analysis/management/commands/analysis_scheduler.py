@@ -0,0 +1,71 @@
+import os
+import socket
+import time
+import uuid
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from stream_analysis import backends
+
+LEADER_LEASE = 'scheduler:leader'
+
+
+class Command(BaseCommand):
+    """
+    Runs the RQ scheduler on any number of nodes.
+    Only the node holding the leader lease enqueues the scheduled jobs.
+    If it dies, another node takes over once its lease expires.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--interval',
+            type='float',
+            dest='interval',
+            default=5.0,
+            help='Check for jobs to enqueue every this many seconds.'
+        ),
+        make_option(
+            '--lease-ttl',
+            type='float',
+            dest='lease_ttl',
+            default=30.0,
+            help='Another node takes over this many seconds after the leader stops.'
+        ),
+    )
+
+    help = "Runs the RQ scheduler, with leader election between nodes."
+
+    def handle(self, *args, **options):
+        interval = options.get('interval')
+        lease_ttl = options.get('lease_ttl')
+        if lease_ttl < interval * 2:
+            raise CommandError("The lease TTL must be at least twice the interval")
+
+        backend = backends.get_backend()
+        if not isinstance(backend, backends.RQBackend):
+            raise CommandError("The analysis scheduler needs the rq backend")
+
+        node = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        scheduler = backend.scheduler
+        leading = False
+
+        print "Scheduler %s started" % node
+        try:
+            while True:
+                if leading:
+                    leading = backend.renew_lease(LEADER_LEASE, node, lease_ttl)
+                    if not leading:
+                        print "Scheduler %s lost the leader lease" % node
+                elif backend.acquire_lease(LEADER_LEASE, node, lease_ttl):
+                    leading = True
+                    print "Scheduler %s is now the leader" % node
+
+                if leading:
+                    scheduler.enqueue_jobs()
+
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if leading:
+                backend.release_lease(LEADER_LEASE, node)
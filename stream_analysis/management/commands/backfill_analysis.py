@@ -1,7 +1,8 @@
 from optparse import make_option
 
 from django.core.management.base import BaseCommand
-from stream_analysis.utils import backfill_tasks, AnalysisTask
+from stream_analysis.backfill import Backfill
+from stream_analysis.utils import AnalysisTask
 
 
 class Command(BaseCommand):
@@ -16,6 +17,27 @@ class Command(BaseCommand):
             default=False,
             help='Backfill even if analyses are not running.'
         ),
+        make_option(
+            '--rate',
+            type='float',
+            dest='max_rate',
+            default=None,
+            help='Create no more than this many frames per second.'
+        ),
+        make_option(
+            '--chunk-size',
+            type='int',
+            dest='chunk_size',
+            default=None,
+            help='Create this many frames at a time.'
+        ),
+        make_option(
+            '--restart',
+            action='store_true',
+            dest='restart',
+            default=False,
+            help='Forget any saved progress and start over.'
+        ),
     )
     help = "Fills in analysis frames for old tweets, for any running analyses or specified key."
     args = "<task_key>"
@@ -28,10 +50,29 @@ class Command(BaseCommand):
             tasks = AnalysisTask.get()
             for task in tasks:
                 if force or task.get_rq_job():
-                    backfill_tasks(task.key)
+                    self.backfill(task, options)
         else:
             task = AnalysisTask.get(key=task_key)
-            if force or task.get_rq_job():
-                backfill_tasks(task.key)
+            if not task:
+                print "No analysis task matching key %s" % task_key
+            elif force or task.get_rq_job():
+                self.backfill(task, options)
             else:
                 print "Task %s is not running! Use --force to ignore." % task.name
+
+    def backfill(self, task, options):
+        backfill = Backfill(task)
+        if options.get('restart'):
+            backfill.reset()
+
+        def report(progress, eta):
+            if not progress:
+                return
+            total = progress['created'] + progress['remaining']
+            print "%s: %d of %d frames (back to %s), about %s left" % (
+                task.name, progress['created'], total, progress['cursor'], eta or "?")
+
+        created = backfill.run(max_rate=options.get('max_rate'),
+                               chunk_size=options.get('chunk_size'),
+                               report=report)
+        print "Backfilled %d frames for task %s" % (created, task.name)
@@ -1,3 +1,5 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 from stream_analysis.utils import cleanup
 
@@ -5,8 +7,34 @@ class Command(BaseCommand):
     """
     Removes streaming data we no longer need.
     """
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--time-budget',
+            type='float',
+            dest='time_budget',
+            default=None,
+            help='Stop after this many seconds. The next run picks up where this one stopped.'
+        ),
+        make_option(
+            '--max-rate',
+            type='float',
+            dest='max_rows_per_second',
+            default=None,
+            help='Delete no more than this many stream items per second.'
+        ),
+        make_option(
+            '--batch-size',
+            type='int',
+            dest='batch_size',
+            default=None,
+            help='Delete this many stream items at a time.'
+        ),
+    )
 
     help = "Removes streaming data we no longer need."
 
     def handle(self, *args, **options):
-        cleanup()
+        deleted = cleanup(time_budget=options.get('time_budget'),
+                          max_rows_per_second=options.get('max_rows_per_second'),
+                          batch_size=options.get('batch_size'))
+        print "Deleted %d stream items" % deleted
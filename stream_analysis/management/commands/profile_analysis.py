@@ -0,0 +1,77 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from stream_analysis import profiling
+from stream_analysis.utils import AnalysisTask
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise CommandError("Could not understand the time %s" % value)
+
+    if settings.USE_TZ and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, timezone.get_default_timezone())
+    return parsed
+
+
+class Command(BaseCommand):
+    """
+    Shows the hot spots in the profiled frames of an analysis task.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--start',
+            dest='start',
+            default=None,
+            help='Only include frames starting at or after this time.'
+        ),
+        make_option(
+            '--end',
+            dest='end',
+            default=None,
+            help='Only include frames starting before this time.'
+        ),
+        make_option(
+            '--top',
+            type='int',
+            dest='top',
+            default=20,
+            help='Show this many functions.'
+        ),
+    )
+
+    help = "Shows the hot spots in the profiled frames of an analysis task."
+    args = "<task_key>"
+
+    def handle(self, task_key=None, *args, **options):
+
+        task = AnalysisTask.get(key=task_key) if task_key else None
+        if not task:
+            print "No analysis task matching key %s" % task_key
+            return
+
+        profiles = profiling.get_profiles(task.get_frame_class(),
+                                          start=_parse_time(options.get('start')),
+                                          end=_parse_time(options.get('end')))
+        if not profiles:
+            print "No profiled frames for task %s. Is profile_rate set?" % task.name
+            return
+
+        hot_spots = profiling.aggregate(profiles, top=options.get('top'))
+
+        print "Hot spots in %d profiled frames of task %s:" % (hot_spots['frames'], task.name)
+        print "%10s %10s %10s  %s" % ("own time", "cum. time", "calls", "function")
+        for function in hot_spots['functions']:
+            print "%10.3f %10.3f %10d  %s" % (function['own_time'], function['cumulative_time'],
+                                              function['calls'], function['name'])
+
+        if hot_spots['max_peak_memory'] is not None:
+            print "Peak memory: %d bytes at most, %d on average" % (hot_spots['max_peak_memory'],
+                                                                    hot_spots['mean_peak_memory'])
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from stream_analysis import watermarks
+from stream_analysis.utils import AnalysisTask
+
+class Command(BaseCommand):
+    """
+    Recalculates the watermarks for the given analysis task, or for all.
+    """
+
+    args = "<task_key>"
+    help = "Recalculates the frame and stream watermarks used for scheduling."
+
+    def handle(self, task_key=None, *args, **options):
+
+        if task_key:
+            task = AnalysisTask.get(key=task_key)
+            if not task:
+                print "No analysis task matching key %s" % task_key
+                return
+            tasks = [task]
+        else:
+            tasks = AnalysisTask.get()
+
+        for task in tasks:
+            values = watermarks.rebuild(task.get_frame_class())
+            print "Rebuilt watermarks for task %s:" % task.key
+            for watermark in watermarks.WATERMARKS:
+                print "  * %s : %s" % (watermark, values[watermark])
@@ -0,0 +1,139 @@
+"""
+Metrics about the analysis tasks, in the Prometheus text format.
+
+Everything here comes from counters that are kept up to date as
+frames are created, analyzed and cleared, and as stream data is
+cleaned up, so reading the metrics never scans the frame tables.
+"""
+
+import backends
+import stats
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+CLEANUP_STATE = 'metrics:cleanup'
+
+
+def _state_name(frame_class):
+    return 'metrics:%s' % frame_class._meta.db_table
+
+
+def frames_created(frame_class, count):
+    """Counts newly created frames."""
+    backends.get_backend().increment_state(_state_name(frame_class), {'frames_created': count})
+
+
+def frames_cleared(frame_class, count):
+    """Counts uncalculated frames that were deleted."""
+    backends.get_backend().increment_state(_state_name(frame_class), {'frames_cleared': count})
+
+
+def stream_cleaned(stream_name, count):
+    """Counts stream items deleted by cleanup."""
+    backends.get_backend().increment_state(CLEANUP_STATE, {stream_name: count})
+
+
+def get_task_metrics(task):
+    """
+    Returns a dict of metrics for an analysis task:
+        frames_created, frames_calculated, frames_pending: frame counts
+        rows: the number of stream items analyzed
+        busy_seconds: the total time spent fetching, calculating, cleaning up and saving
+        mode, lag, queue_depth: from the task's last scheduling tick
+        stages: a dict of stage -> (count, total seconds, dict of bucket -> count)
+    """
+    frame_class = task.get_frame_class()
+
+    counters = backends.get_backend().get_state(_state_name(frame_class))
+    created = int(counters.get('frames_created') or 0)
+    cleared = int(counters.get('frames_cleared') or 0)
+
+    totals = stats.get_totals(frame_class)
+    calculated = totals.get('frames', 0)
+
+    busy = sum(totals.get('%s.sum' % stage, 0) for stage in stats.BUSY_STAGES) / 1e6
+
+    metrics = {
+        'frames_created': created,
+        'frames_calculated': calculated,
+        'frames_pending': max(0, created - cleared - calculated),
+        'rows': totals.get('rows', 0),
+        'busy_seconds': busy,
+        'stages': {},
+    }
+    metrics.update(task.get_status())
+
+    for stage in stats.STAGES:
+        metrics['stages'][stage] = (totals.get('%s.count' % stage, 0),
+                                    totals.get('%s.sum' % stage, 0) / 1e6,
+                                    stats.get_buckets(totals, stage))
+
+    return metrics
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in sorted(labels.iteritems()))
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(tasks):
+    """Returns the metrics for the given analysis tasks in the Prometheus text format."""
+    lines = []
+
+    def family(name, metric_type, help_text):
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+
+    def sample(name, value, **labels):
+        if value is not None:
+            lines.append('%s%s %s' % (name, _labels(**labels) if labels else '', _number(value)))
+
+    task_metrics = [(task, get_task_metrics(task)) for task in tasks]
+
+    family('stream_analysis_queue_depth', 'gauge', 'Jobs waiting on the default queue.')
+    sample('stream_analysis_queue_depth', backends.get_backend().get_queue_depth())
+
+    simple = (
+        ('stream_analysis_frames_created_total', 'frames_created', 'counter', 'Frames created.'),
+        ('stream_analysis_frames_calculated_total', 'frames_calculated', 'counter', 'Frames calculated.'),
+        ('stream_analysis_frames_pending', 'frames_pending', 'gauge', 'Frames created but not yet calculated.'),
+        ('stream_analysis_rows_total', 'rows', 'counter', 'Stream items analyzed.'),
+        ('stream_analysis_busy_seconds_total', 'busy_seconds', 'counter', 'Seconds spent analyzing frames.'),
+        ('stream_analysis_lag_seconds', 'lag', 'gauge', 'Seconds the calculated frames are behind the stream.'),
+        ('stream_analysis_task_queue_depth', 'queue_depth', 'gauge', 'Jobs waiting at the last scheduling tick.'),
+    )
+    for name, key, metric_type, help_text in simple:
+        family(name, metric_type, help_text)
+        for task, metrics in task_metrics:
+            sample(name, metrics[key], task=task.key)
+
+    family('stream_analysis_catch_up', 'gauge', '1 if the task is in catch-up mode.')
+    for task, metrics in task_metrics:
+        sample('stream_analysis_catch_up', int(metrics['mode'] == task.CATCH_UP), task=task.key)
+
+    family('stream_analysis_stage_seconds', 'histogram', 'Time taken by each stage of frame analysis.')
+    for task, metrics in task_metrics:
+        for stage in stats.STAGES:
+            count, total, buckets = metrics['stages'][stage]
+            # The same buckets every time, so that Prometheus can compare scrapes
+            for upper_bound, seen in stats.get_ladder(buckets):
+                sample('stream_analysis_stage_seconds_bucket', seen, task=task.key, stage=stage,
+                       le=_number(upper_bound))
+            sample('stream_analysis_stage_seconds_bucket', count, task=task.key, stage=stage, le='+Inf')
+            sample('stream_analysis_stage_seconds_sum', total, task=task.key, stage=stage)
+            sample('stream_analysis_stage_seconds_count', count, task=task.key, stage=stage)
+
+    family('stream_analysis_cleanup_deleted_total', 'counter', 'Stream items deleted by cleanup.')
+    for stream_name, count in sorted(backends.get_backend().get_state(CLEANUP_STATE).iteritems()):
+        sample('stream_analysis_cleanup_deleted_total', int(count), stream=stream_name)
+
+    return '\n'.join(lines) + '\n'
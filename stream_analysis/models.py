@@ -1,9 +1,70 @@
+import contextlib
 import datetime
+import random
+import threading
 import time
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
+import frame_cache
+import series
+import stats
 import streams
+import watermarks
+
+# The callbacks held back inside an after_commit() block, for each thread
+_pending = threading.local()
+
+
+@contextlib.contextmanager
+def after_commit():
+    """
+    Holds back the watermark, frame cache and stats updates for frames
+    marked done inside the block, and applies them once it exits without an error.
+    Wrap it around transaction.atomic(), so that no other process recomputes
+    a watermark or caches frames that are calculated but not committed yet,
+    and a rolled back batch that is retried is only counted once.
+    """
+    if getattr(_pending, 'callbacks', None) is not None:
+        # The outer block will apply them
+        yield
+        return
+
+    _pending.callbacks = []
+    try:
+        yield
+        callbacks = _pending.callbacks
+    finally:
+        _pending.callbacks = None
+
+    for callback, args in callbacks:
+        callback(*args)
+
+
+def on_commit(callback, *args):
+    """
+    Calls callback(*args) once the after_commit() block around it
+    exits without an error, or right away outside of one.
+    """
+    pending = getattr(_pending, 'callbacks', None)
+    if pending is not None:
+        pending.append((callback, args))
+    else:
+        callback(*args)
+
+
+def _frame_committed(frame):
+    """Updates the watermarks and cache for a calculated frame, once it is committed."""
+    watermarks.frame_calculated(frame)
+    frame_cache.frame_changed(frame)
+
+
+def _average(values):
+    """The mean of the values that are not None, or None."""
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return sum(values) / len(values)
 
 
 class TimedIntervalMixin(models.Model):
@@ -138,6 +199,10 @@ class BaseTimeFrame(TimedIntervalMixin, models.Model):
        if your data is not strictly 1:1 with time frames.
     4. Implement calculate(self, stream_data, task). This is where you do your work.
        At the end, return any data you are done with.
+       For very large frames, implement calculate_incremental(self, chunk)
+       and finalize(self) instead.
+       For frames that summarize finer frames, set ROLLUP_SOURCE_CLASS
+       and implement combine(self, child_frames) instead.
     5. Add any additional functions related to your time frames
        that will make them easier to work with.
     """
@@ -146,9 +211,26 @@ class BaseTimeFrame(TimedIntervalMixin, models.Model):
     # Recommended to extend AbstractStream.
     STREAM_CLASS = streams.AbstractStream
 
+    # The fields that identify a frame.
+    KEY_FIELDS = ('start_time',)
+
+    # The stream fields to pass to calculate() as a StreamBatch of columns,
+    # if the stream class implements get_stream_columns().
+    STREAM_COLUMNS = None
+
+    # For rollup frames, the finer time frame class to combine.
+    # Rollup frames are calculated from the finished frames of
+    # this class, using combine(), and never read the stream.
+    ROLLUP_SOURCE_CLASS = None
+
     # Tells Django not to make a table for this abstract class.
+    # Scheduling looks up frames by calculated and start_time together.
+    # Subclasses that declare their own Meta should extend this one.
     class Meta:
         abstract = True
+        index_together = [
+            ('calculated', 'start_time'),
+        ]
 
     # True if this frame has been calculated
     calculated = models.BooleanField(default=False)
@@ -156,7 +238,8 @@ class BaseTimeFrame(TimedIntervalMixin, models.Model):
     # True if we think the data for this frame is missing data
     missing_data = models.BooleanField(default=False)
 
-    # The time in seconds taken by analysis. Before calculated=True, this is analysis start time.
+    # The time in seconds taken by analysis. Before calculated=True, this is analysis start time,
+    # or a negative claim token from claim_frames(), which also marks the frame as claimed by a worker.
     analysis_time = models.FloatField(default=None, null=True, blank=True)
 
     # The time in seconds taken for cleanup.
@@ -174,12 +257,62 @@ class BaseTimeFrame(TimedIntervalMixin, models.Model):
 
         The 'stream_data' parameter is the
         all of the stream data enclosed in this time frame.
+        If STREAM_COLUMNS is set, it is a StreamBatch of those fields.
 
         Set self.missing_data field to True to indicate
         if the time frame had incomplete data.
         """
         pass
 
+    def calculate_incremental(self, chunk):
+        """
+        Perform the analysis procedure for one chunk of
+        the stream data in this time frame.
+
+        Optional alternative to calculate(). If overridden, and the
+        stream class implements iter_stream_data(), this is called for
+        each chunk of stream data in turn, followed by finalize().
+        """
+        raise NotImplementedError
+
+    def finalize(self):
+        """
+        Called after the last chunk has been passed to calculate_incremental().
+        """
+        pass
+
+    def combine(self, child_frames):
+        """
+        Perform the analysis procedure for a rollup frame.
+
+        Should be overridden in derived classes that set ROLLUP_SOURCE_CLASS.
+
+        The 'child_frames' parameter contains the calculated
+        frames of ROLLUP_SOURCE_CLASS that start within this time frame.
+        """
+        pass
+
+    def get_child_frames(self):
+        """
+        Returns the calculated ROLLUP_SOURCE_CLASS frames
+        that start within this rollup frame.
+        """
+        source_class = type(self).ROLLUP_SOURCE_CLASS
+        return source_class.objects \
+            .filter(calculated=True, start_time__gte=self.start_time, start_time__lt=self.end_time) \
+            .order_by('start_time')
+
+    def get_stream_filter(self):
+        """
+        Returns the extra keyword arguments passed to the stream's
+        get_stream_data() and iter_stream_data() for this frame.
+        """
+        return {}
+
+    def get_key(self):
+        """Returns the values of the KEY_FIELDS that identify this frame."""
+        return tuple(getattr(self, name) for name in type(self).KEY_FIELDS)
+
     def cleanup(self):
         """
         Perform any maintenance tasks on the analysis
@@ -194,6 +327,51 @@ class BaseTimeFrame(TimedIntervalMixin, models.Model):
         pass
 
 
+    @classmethod
+    def make_frames(cls, start_time):
+        """Returns the new (unsaved) frames that start at start_time."""
+        return [cls(start_time=start_time)]
+
+    @classmethod
+    def is_partitioned(cls):
+        """True if there are several frames for each interval."""
+        return False
+
+    @classmethod
+    def is_rollup(cls):
+        """True if these frames are combined from finer frames."""
+        return cls.ROLLUP_SOURCE_CLASS is not None
+
+    @classmethod
+    def get_rollup_ready_time(cls):
+        """
+        For rollup frames, get the datetime before which every
+        frame of ROLLUP_SOURCE_CLASS has been calculated.
+        Returns None if there are no source frames.
+        """
+        source_class = cls.ROLLUP_SOURCE_CLASS
+
+        earliest_uncalculated = watermarks.get(source_class, watermarks.EARLIEST_UNCALCULATED)
+        if earliest_uncalculated is not None:
+            return earliest_uncalculated
+
+        return watermarks.get(source_class, watermarks.LATEST_END)
+
+    @classmethod
+    def get_earliest_uncalculated_start_time(cls, exclude_ids=None):
+        """
+        Returns the start time of the earliest frame not yet calculated, or None.
+        Reads a single entry from the (calculated, start_time) index.
+        Frames in exclude_ids are skipped.
+        """
+        frames = cls.objects.filter(calculated=False)
+        if exclude_ids:
+            frames = frames.exclude(pk__in=exclude_ids)
+        start_times = list(frames
+                           .order_by('start_time')
+                           .values_list('start_time', flat=True)[:1])
+        return start_times[0] if start_times else None
+
     @classmethod
     def get_stream_memory_cutoff(cls):
         """
@@ -205,59 +383,105 @@ class BaseTimeFrame(TimedIntervalMixin, models.Model):
         If there are no timeframes, returns the None (meaning don't delete anything)
 
         If you require more data than this to be preserved, make sure to extend this method.
-        """
-        result = cls.objects.filter(calculated=False)\
-            .aggregate(earliest_start_time=models.Min('start_time'))
-
-        if result['earliest_start_time'] is not None:
-            return result['earliest_start_time']
 
-        result = cls.objects.filter(calculated=True) \
-            .aggregate(latest_start_time=models.Max('start_time'))
+        This reads the watermarks kept for the frame class, not the frame table.
+        """
+        earliest_uncalculated = watermarks.get(cls, watermarks.EARLIEST_UNCALCULATED)
+        if earliest_uncalculated is not None:
+            return earliest_uncalculated
 
-        if result['latest_start_time'] is not None:
-            return result['latest_start_time']
+        # Every frame is calculated, so this is the start of the latest one
+        latest_end = watermarks.get(cls, watermarks.LATEST_END)
+        if latest_end is not None:
+            return latest_end - cls.DURATION
 
         return None
 
     def mark_started(self):
         """
-        Saves the current time, indicating analysis is beginning.
-        This will be called for you.
+        Claims this frame for analysis by saving the current time,
+        unless it was already calculated or claimed by someone else.
+        Returns True if the claim succeeded.
         """
-        self.analysis_time = time.time()
-        self.save()
+        started = time.time()
+        claimed = type(self).objects \
+            .filter(pk=self.pk, calculated=False, analysis_time__isnull=True) \
+            .update(analysis_time=started)
+
+        self.analysis_time = started
+        self._analysis_started = started
+        return claimed > 0
 
     def mark_cleanup_started(self):
         """
-        Saves the current time, indicating cleanup is beginning.
+        Notes the current time, indicating cleanup is beginning.
         This will be called for you.
         """
-        self.cleanup_time = time.time()
-        self.save()
+        self._cleanup_started = time.time()
 
     def mark_done(self):
         """
-        Marks the time frame as calculated.
+        Marks the time frame as calculated and saves it,
+        along with the time taken for analysis and cleanup.
         This will be called for you. If you override it,
         make sure to do all these things yourself.
         """
 
+        now = time.time()
         self.calculated = True
 
         # Calculate the time taken for cleanup
-        if self.cleanup_time:
-            self.cleanup_time = time.time() - self.cleanup_time
+        cleanup_started = getattr(self, '_cleanup_started', None)
+        if cleanup_started:
+            self.cleanup_time = now - cleanup_started
 
         # Calculate the time taken for analysis
-        if self.analysis_time:
-            self.analysis_time = time.time() - self.analysis_time
+        analysis_started = getattr(self, '_analysis_started', None)
+        if analysis_started:
+            self.analysis_time = now - analysis_started
 
             # Deduct the cleanup time
-            if self.cleanup_time:
+            if cleanup_started:
                 self.analysis_time -= self.cleanup_time
 
-        self.save()
+        self.save(update_fields=type(self).get_result_field_names())
+
+        on_commit(_frame_committed, self)
+
+    @classmethod
+    def get_result_field_names(cls):
+        """
+        The names of the fields that analysis may change.
+        That is everything except the primary key and KEY_FIELDS.
+        """
+        return [field.name for field in cls._meta.fields
+                if not field.primary_key and field.name not in cls.KEY_FIELDS]
+
+    @classmethod
+    def claim_frames(cls, frame_ids):
+        """
+        Claims the frames with the given ids for analysis,
+        as mark_started() does, with a single update.
+        Returns the claimed frames in start time order.
+        Frames already calculated or claimed are left out.
+        """
+        started = time.time()
+
+        # A token unique to this claim, so that two workers claiming at
+        # the same moment can't both think they own the same frames.
+        # Whole numbers are stored exactly by every database.
+        token = -float(random.SystemRandom().randint(1, 2 ** 52))
+        cls.objects \
+            .filter(pk__in=frame_ids, calculated=False, analysis_time__isnull=True) \
+            .update(analysis_time=token)
+
+        frames = list(cls.objects
+                      .filter(pk__in=frame_ids, calculated=False, analysis_time=token)
+                      .order_by('start_time'))
+        for frame in frames:
+            frame._analysis_started = started
+
+        return frames
 
     def __unicode__(self):
         """Printing for Django admin / debugging"""
@@ -265,19 +489,120 @@ class BaseTimeFrame(TimedIntervalMixin, models.Model):
 
     @classmethod
     def get_performance_stats(cls, start=None, end=None):
-        """Returns the average time taken to analyze and cleanup these time frames."""
+        """
+        Returns the average time taken to analyze and cleanup these time frames,
+        along with timings for each stage of analysis (see stream_analysis.stats)
+        and the number of stream items processed per second.
+        Stage timings are kept by the hour, so they cover
+        every hour that overlaps start and end.
+
+        With ANALYSIS_FRAME_CACHE, the averages for a range
+        with a start and end are worked out from cached frames.
+        """
 
-        query = cls.get_in_range(start=start, end=end, calculated=True)
+        if frame_cache.is_enabled() and start is not None and end is not None:
+            frames = frame_cache.get_frames(cls, start, end)
+            result = {
+                'average_analysis_time': _average(frame.analysis_time for frame in frames),
+                'average_cleanup_time': _average(frame.cleanup_time for frame in frames),
+            }
+        else:
+            query = cls.get_in_range(start=start, end=end, calculated=True)
+            result = query.aggregate(average_analysis_time=models.Avg('analysis_time'),
+                                     average_cleanup_time=models.Avg('cleanup_time'))
 
-        result = query.aggregate(average_analysis_time=models.Avg('analysis_time'),
-                                 average_cleanup_time=models.Avg('cleanup_time'))
+        stage_stats = stats.summarize(cls, start=start, end=end)
         return {
             'analysis_time': result['average_analysis_time'],
             'cleanup_time': result['average_cleanup_time'],
+            'stages': dict((stage, stage_stats[stage]) for stage in stats.STAGES),
+            'rows': stage_stats['rows'],
+            'rows_per_second': stage_stats['rows_per_second'],
         }
 
+    @classmethod
+    def get_calculated_frames(cls, start, end):
+        """
+        Returns a list of the calculated frames overlapping start and end,
+        in start time order. With ANALYSIS_FRAME_CACHE set, they are
+        served from the cache, which is kept up to date as frames are calculated.
+        """
+        return frame_cache.get_frames(cls, start, end)
+
+    @classmethod
+    def get_series(cls, fields, start=None, end=None, resolution=None, how='mean'):
+        """
+        Returns the given numeric fields of the calculated frames between start and end
+        as a columnar stream_analysis.series.Series, without creating a model per frame.
+        Call to_numpy() on the result to get NumPy arrays.
+
+        If resolution (a timedelta) is given, the frames are downsampled
+        to buckets of that length with the 'how' aggregate (mean, sum, min or max).
+        """
+        return series.get_series(cls, fields, start=start, end=end, resolution=resolution, how=how)
+
     @classmethod
     def count_completed(cls):
         """Counts the number of completed frames of this type."""
         query = cls.get_in_range(calculated=True)
         return query.count()
+
+
+class PartitionedTimeFrame(BaseTimeFrame):
+    """
+    A time frame with a separate frame for each partition
+    of the stream, such as a keyword or a region,
+    in every interval of DURATION.
+
+    List the partitions in PARTITIONS, or override get_partitions().
+    Each frame is passed only the stream data for its partition:
+    the stream's get_stream_data() and iter_stream_data() receive
+    a partition keyword argument. The frames for different partitions
+    are analyzed in separate jobs, so they run in parallel.
+    """
+
+    # The keys of the partitions to analyze
+    PARTITIONS = ()
+
+    KEY_FIELDS = ('start_time', 'partition')
+
+    class Meta(BaseTimeFrame.Meta):
+        abstract = True
+        unique_together = [
+            ('start_time', 'partition'),
+        ]
+
+    # The key of the partition this frame analyzes
+    partition = models.CharField(max_length=100, db_index=True)
+
+    @classmethod
+    def get_partitions(cls):
+        """Returns the keys of the partitions that new frames are created for."""
+        return list(cls.PARTITIONS)
+
+    @classmethod
+    def make_frames(cls, start_time):
+        """Returns a new (unsaved) frame for each partition, starting at start_time."""
+        return [cls(start_time=start_time, partition=partition) for partition in cls.get_partitions()]
+
+    @classmethod
+    def is_partitioned(cls):
+        return True
+
+    def get_stream_filter(self):
+        return {'partition': self.partition}
+
+    def get_child_frames(self):
+        """
+        Returns the calculated ROLLUP_SOURCE_CLASS frames
+        that start within this rollup frame, and have the
+        same partition if the source frames are partitioned.
+        """
+        child_frames = super(PartitionedTimeFrame, self).get_child_frames()
+        if type(self).ROLLUP_SOURCE_CLASS.is_partitioned():
+            child_frames = child_frames.filter(partition=self.partition)
+        return child_frames
+
+    def __unicode__(self):
+        """Printing for Django admin / debugging"""
+        return "Frame %s (%s)" % (self.start_time, self.partition)
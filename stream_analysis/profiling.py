@@ -0,0 +1,179 @@
+"""
+Sampled profiling of frame analysis.
+
+Tasks with a "profile_rate" run that fraction of their frames
+under cProfile and, where available, tracemalloc. The "profile_top"
+functions with the most time of their own and the peak memory
+allocated are saved for each sampled frame, in the backend state
+store, grouped by the hour of stream time the frame started in.
+Old hours are dropped after ANALYSIS_STATS_RETENTION, as stats are.
+
+Without tracemalloc, the peak memory is how much the frame raised
+the peak resident size of the process (ru_maxrss) instead. That is
+zero for frames that stay below an earlier peak, so look at the
+maximum across frames rather than the mean.
+
+Frames that are not sampled only pay for a random number.
+"""
+
+import cProfile
+import json
+import pstats
+import random
+import sys
+
+from django.utils.dateparse import parse_datetime
+import backends
+import stats
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has it only as the pytracemalloc patch
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows
+    resource = None
+
+
+def get_max_rss():
+    """The peak resident size of the process in bytes. Requires the resource module."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Mac OS reports bytes, Linux kilobytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class FrameProfile(object):
+    """Profiles the analysis of a single frame."""
+
+    def __init__(self, top):
+        self.top = top
+        self.profiler = cProfile.Profile()
+        self.trace_memory = False
+        self.max_rss_before = None
+        self.peak_memory = None
+
+    def start(self):
+        # Don't interfere with anyone else tracing memory
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.trace_memory = True
+        elif resource is not None:
+            self.max_rss_before = get_max_rss()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        if self.trace_memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.trace_memory = False
+        elif self.max_rss_before is not None:
+            self.peak_memory = max(0, get_max_rss() - self.max_rss_before)
+            self.max_rss_before = None
+
+    def get_functions(self):
+        """
+        Returns the top functions by time spent in the function itself,
+        as [name, calls, own time, cumulative time] lists.
+        """
+        functions = []
+        for (filename, line, name), values in pstats.Stats(self.profiler).stats.iteritems():
+            calls, own_time, cumulative_time = values[1], values[2], values[3]
+            functions.append(['%s:%d(%s)' % (filename, line, name), calls, own_time, cumulative_time])
+
+        functions.sort(key=lambda function: function[2], reverse=True)
+        return functions[:self.top]
+
+
+def sample(rate, top):
+    """Returns a FrameProfile for a random fraction (rate) of calls, otherwise None."""
+    if rate and random.random() < rate:
+        return FrameProfile(top)
+    return None
+
+
+_hours = stats.HourlyState('profiles')
+
+
+def save(frame, profile):
+    """Saves the results of profiling a frame."""
+    frame_class = type(frame)
+    hour = stats._hour(frame.start_time)
+
+    result = {
+        'start_time': frame.start_time.isoformat(),
+        'functions': profile.get_functions(),
+        'peak_memory': profile.peak_memory,
+    }
+
+    if _hours.add_hour(frame_class, hour):
+        backends.get_backend().update_state(_hours.state_name(frame_class, hour),
+                                            {str(frame.pk): json.dumps(result)})
+
+
+def get_profiles(frame_class, start=None, end=None):
+    """
+    Returns the saved profiles for frames that started between start and end,
+    as dicts with the frame's start_time, its top functions and peak_memory.
+    """
+    backend = backends.get_backend()
+
+    profiles = []
+    for hour in _hours.get_hours(frame_class, start, end):
+        for value in backend.get_state(_hours.state_name(frame_class, hour)).itervalues():
+            profile = json.loads(value)
+            profile['start_time'] = parse_datetime(profile['start_time'])
+            if start is not None and profile['start_time'] < start:
+                continue
+            if end is not None and profile['start_time'] >= end:
+                continue
+            profiles.append(profile)
+
+    profiles.sort(key=lambda profile: profile['start_time'])
+    return profiles
+
+
+def aggregate(profiles, top=20):
+    """
+    Combines profiles into the hot spots across all of them.
+
+    Returns a dict with the top functions by total time of their own,
+    as dicts of name, frames, calls, own_time and cumulative_time,
+    and the maximum and mean peak_memory in bytes (or None).
+    """
+    functions = {}
+    for profile in profiles:
+        for name, calls, own_time, cumulative_time in profile['functions']:
+            function = functions.get(name)
+            if function is None:
+                function = functions[name] = {
+                    'name': name,
+                    'frames': 0,
+                    'calls': 0,
+                    'own_time': 0.0,
+                    'cumulative_time': 0.0,
+                }
+            function['frames'] += 1
+            function['calls'] += calls
+            function['own_time'] += own_time
+            function['cumulative_time'] += cumulative_time
+
+    hot_spots = sorted(functions.itervalues(), key=lambda function: function['own_time'], reverse=True)
+
+    peaks = [profile['peak_memory'] for profile in profiles if profile.get('peak_memory') is not None]
+
+    return {
+        'frames': len(profiles),
+        'functions': hot_spots[:top],
+        'max_peak_memory': max(peaks) if peaks else None,
+        'mean_peak_memory': sum(peaks) / float(len(peaks)) if peaks else None,
+    }
+
+
+def clear(frame_class):
+    """Forgets all of the saved profiles for the frame class."""
+    _hours.clear(frame_class)
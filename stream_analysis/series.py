@@ -0,0 +1,142 @@
+"""
+Columnar export of time frame fields, for plotting long ranges of frames.
+
+Rows are streamed straight from values_list() into compact arrays,
+without creating a model instance for each frame, and can be
+downsampled to a coarser resolution along the way.
+"""
+
+import calendar
+import datetime
+from array import array
+
+from django.utils import timezone
+
+AGGREGATES = ('mean', 'sum', 'min', 'max')
+
+NAN = float('nan')
+
+
+def _epoch_seconds(value):
+    if timezone.is_aware(value):
+        value = value.astimezone(timezone.utc)
+    return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+
+
+class Series(object):
+    """
+    Frame start times and field values, as arrays of floats.
+    Start times are in seconds since the epoch (UTC),
+    and missing values are NaN.
+    """
+
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self.times = array('d')
+        self.columns = dict((field, array('d')) for field in self.fields)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def append(self, time, values):
+        self.times.append(time)
+        for field, value in zip(self.fields, values):
+            self.columns[field].append(NAN if value is None else value)
+
+    def get_datetimes(self):
+        """Returns the start times as a list of UTC datetimes."""
+        return [datetime.datetime.utcfromtimestamp(time).replace(tzinfo=timezone.utc) for time in self.times]
+
+    def to_numpy(self):
+        """
+        Returns a dict of NumPy arrays, sharing memory with the series:
+        start_time as datetime64 and each field as float64.
+        Requires NumPy.
+        """
+        import numpy
+
+        def as_float64(values):
+            if not len(values):
+                return numpy.zeros(0)
+            return numpy.frombuffer(values, dtype=numpy.float64)
+
+        result = {'start_time': (as_float64(self.times) * 1e6).astype('datetime64[us]')}
+        for field in self.fields:
+            result[field] = as_float64(self.columns[field])
+        return result
+
+
+class _Bucket(object):
+    """Combines the rows falling in one downsampling bucket."""
+
+    def __init__(self, time, width, how):
+        self.time = time
+        self.how = how
+        self.totals = [None] * width
+        self.counts = [0] * width
+
+    def add(self, values):
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+
+            total = self.totals[i]
+            if total is None:
+                self.totals[i] = value
+            elif self.how in ('mean', 'sum'):
+                self.totals[i] = total + value
+            elif self.how == 'min':
+                self.totals[i] = min(total, value)
+            else:
+                self.totals[i] = max(total, value)
+            self.counts[i] += 1
+
+    def get_values(self):
+        if self.how != 'mean':
+            return self.totals
+        return [total / float(count) if count else None for total, count in zip(self.totals, self.counts)]
+
+
+def get_series(frame_class, fields, start=None, end=None, resolution=None, how='mean'):
+    """
+    Returns a Series of the given numeric fields for the calculated frames
+    overlapping start and end, in start time order.
+
+    If resolution (a timedelta) is given, frames are combined into
+    buckets of that length, aligned to the epoch, using the 'how' aggregate:
+    one of mean, sum, min or max. Each bucket's time is its start.
+    """
+    if how not in AGGREGATES:
+        raise ValueError("Unknown aggregate %s" % how)
+
+    fields = list(fields)
+    series = Series(fields)
+
+    rows = frame_class.get_in_range(start=start, end=end, calculated=True) \
+        .order_by('start_time') \
+        .values_list('start_time', *fields) \
+        .iterator()
+
+    if resolution is None:
+        for row in rows:
+            series.append(_epoch_seconds(row[0]), row[1:])
+        return series
+
+    bucket_seconds = resolution.total_seconds()
+    bucket = None
+    for row in rows:
+        time = _epoch_seconds(row[0])
+        bucket_time = time - time % bucket_seconds
+        if bucket is None or bucket.time != bucket_time:
+            if bucket is not None:
+                series.append(bucket.time, bucket.get_values())
+            bucket = _Bucket(bucket_time, len(fields), how)
+        bucket.add(row[1:])
+
+    if bucket is not None:
+        series.append(bucket.time, bucket.get_values())
+
+    return series
@@ -12,8 +12,84 @@ ANALYSIS_TIME_FRAME_TASKS = {
         "autostart": True,
     },
 }
+
+Time frame classes are reloaded when their source changes.
+Set ANALYSIS_AUTO_RELOAD = False to turn this off.
+
+Analysis runs on RQ by default. To run it inside the current process
+instead, on a pool of 4 threads, set:
+
+ANALYSIS_BACKEND = "local"
+ANALYSIS_LOCAL_WORKERS = 4
+
+Stream cleanup deletes 10000 items at a time with no pause by default:
+
+ANALYSIS_CLEANUP_BATCH_SIZE = 10000
+ANALYSIS_CLEANUP_SLEEP = 0.0
+
+Tasks in the same "stream_group" fetch their stream data together,
+holding at most this many seconds of stream data at once:
+
+ANALYSIS_SHARED_FETCH_MAX_SPAN = 3600
+
+Backfilled frames are analyzed on their own RQ queue, which must be
+listed in RQ_QUEUES. They are created 100 at a time, optionally no faster
+than a number of frames per second:
+
+ANALYSIS_BACKFILL_QUEUE = "low"
+ANALYSIS_BACKFILL_CHUNK_SIZE = 100
+ANALYSIS_BACKFILL_RATE = None
+
+Calculated frames can be cached, in hour-long buckets, for a day,
+in a Django cache or in an LRU cache of 256 buckets in the memory of each process:
+
+ANALYSIS_FRAME_CACHE = None  # or "local", or a CACHES alias
+ANALYSIS_FRAME_CACHE_SIZE = 256
+ANALYSIS_FRAME_CACHE_BUCKET = 3600
+ANALYSIS_FRAME_CACHE_TIMEOUT = 24 * 3600
+
+Frames that keep getting abandoned by dead workers are eventually
+given up on. They hold back stream cleanup and the lag unless
+they are left out of the earliest uncalculated frame:
+
+ANALYSIS_EXCLUDE_DEAD_FRAMES = False
+
+Performance stats and profiles are kept by the hour of stream time, for a week
+of hours before the latest (None to keep them all):
+
+ANALYSIS_STATS_RETENTION = 7 * 24 * 3600
 """
 
 from django.conf import settings
 
 TIME_FRAME_TASKS = getattr(settings, 'ANALYSIS_TIME_FRAME_TASKS', {})
+
+AUTO_RELOAD = getattr(settings, 'ANALYSIS_AUTO_RELOAD', True)
+
+BACKEND = getattr(settings, 'ANALYSIS_BACKEND', 'rq')
+
+LOCAL_WORKERS = getattr(settings, 'ANALYSIS_LOCAL_WORKERS', 4)
+
+CLEANUP_BATCH_SIZE = getattr(settings, 'ANALYSIS_CLEANUP_BATCH_SIZE', 10000)
+
+CLEANUP_SLEEP = getattr(settings, 'ANALYSIS_CLEANUP_SLEEP', 0.0)
+
+SHARED_FETCH_MAX_SPAN = getattr(settings, 'ANALYSIS_SHARED_FETCH_MAX_SPAN', 3600)
+
+BACKFILL_QUEUE = getattr(settings, 'ANALYSIS_BACKFILL_QUEUE', 'low')
+
+BACKFILL_CHUNK_SIZE = getattr(settings, 'ANALYSIS_BACKFILL_CHUNK_SIZE', 100)
+
+BACKFILL_RATE = getattr(settings, 'ANALYSIS_BACKFILL_RATE', None)
+
+FRAME_CACHE = getattr(settings, 'ANALYSIS_FRAME_CACHE', None)
+
+FRAME_CACHE_SIZE = getattr(settings, 'ANALYSIS_FRAME_CACHE_SIZE', 256)
+
+FRAME_CACHE_BUCKET = getattr(settings, 'ANALYSIS_FRAME_CACHE_BUCKET', 3600)
+
+FRAME_CACHE_TIMEOUT = getattr(settings, 'ANALYSIS_FRAME_CACHE_TIMEOUT', 24 * 3600)
+
+EXCLUDE_DEAD_FRAMES = getattr(settings, 'ANALYSIS_EXCLUDE_DEAD_FRAMES', False)
+
+STATS_RETENTION = getattr(settings, 'ANALYSIS_STATS_RETENTION', 7 * 24 * 3600)
@@ -0,0 +1,268 @@
+"""
+Timing histograms for the stages of frame analysis:
+
+queue_wait: from queueing a frame's job to claiming the frame
+fetch: getting the stream data (or child frames) for the frame
+calculate: calculate(), calculate_incremental() or combine()
+cleanup: cleanup()
+db_write: saving the results with mark_done()
+
+The timings of every analyzed frame are added to a histogram
+for its frame class and the hour of stream time it started in,
+along with the number of stream items it processed.
+Histograms are kept in the backend state store and have
+logarithmic buckets, each about 19% wider than the last,
+so percentiles are accurate to within about 10%.
+A running total of all of the hourly histograms is kept as well.
+Hours more than ANALYSIS_STATS_RETENTION seconds before the latest
+are dropped, but stay in the running total.
+"""
+
+import datetime
+import math
+
+from django.utils import timezone
+import backends
+import settings
+
+STAGES = ('queue_wait', 'fetch', 'calculate', 'cleanup', 'db_write')
+
+# The stages that count as time spent processing rows
+BUSY_STAGES = ('fetch', 'calculate', 'cleanup', 'db_write')
+
+PERCENTILES = (50, 95, 99)
+
+BUCKET_BASE = 2 ** 0.25
+
+# Shorter times share the first bucket
+SMALLEST_TIME = 1e-6
+
+HOUR_FORMAT = '%Y%m%d%H'
+
+# Stored in place of an hour for the running totals
+TOTAL = 'total'
+
+
+# A fixed ladder of every fourth bucket, whose upper bounds are the
+# powers of 2 from about 1 millisecond to about 1 hour, for exporting
+LADDER = [4 * power - 1 for power in range(-10, 13)]
+
+
+def _bucket(seconds):
+    return int(math.floor(math.log(max(seconds, SMALLEST_TIME), BUCKET_BASE)))
+
+
+def _bucket_value(bucket):
+    """The time in the middle of a bucket."""
+    return BUCKET_BASE ** (bucket + 0.5)
+
+
+def bucket_upper_bound(bucket):
+    """The longest time in a bucket."""
+    return BUCKET_BASE ** (bucket + 1)
+
+
+def _hour(value):
+    if timezone.is_aware(value):
+        value = value.astimezone(timezone.utc)
+    return value.strftime(HOUR_FORMAT)
+
+
+class HourlyState(object):
+    """
+    A hash in the backend state store for each frame class and hour,
+    named prefix:table:hour, with an index of the hours in prefix:table.
+    Hours more than ANALYSIS_STATS_RETENTION seconds before the
+    latest hour are deleted, once per process when a new hour is added.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # The latest hour this process has added, by table
+        self._latest = {}
+
+    def index_name(self, frame_class):
+        return '%s:%s' % (self.prefix, frame_class._meta.db_table)
+
+    def state_name(self, frame_class, hour):
+        return '%s:%s:%s' % (self.prefix, frame_class._meta.db_table, hour)
+
+    def add_hour(self, frame_class, hour):
+        """
+        Adds an hour to the index. Returns False, without adding it,
+        if the hour is too old to keep.
+        """
+        table = frame_class._meta.db_table
+        latest = self._latest.get(table)
+        if latest is None or hour > latest:
+            self._latest[table] = latest = hour
+            self.prune(frame_class, _cutoff(hour))
+
+        if hour < _cutoff(latest):
+            return False
+
+        backends.get_backend().update_state(self.index_name(frame_class), {hour: 1})
+        return True
+
+    def prune(self, frame_class, cutoff):
+        """Deletes the hours before cutoff."""
+        backend = backends.get_backend()
+        hours = [hour for hour in backend.get_state(self.index_name(frame_class)) if hour < cutoff]
+        for hour in hours:
+            backend.delete_state(self.state_name(frame_class, hour))
+        backend.remove_state(self.index_name(frame_class), hours)
+
+    def get_hours(self, frame_class, start=None, end=None):
+        """Returns the hours in the index that overlap start and end, in order."""
+        hours = sorted(backends.get_backend().get_state(self.index_name(frame_class)))
+        if start is not None:
+            first = _hour(start)
+            hours = [hour for hour in hours if hour >= first]
+        if end is not None:
+            last = _hour(end - datetime.timedelta(microseconds=1))
+            hours = [hour for hour in hours if hour <= last]
+        return hours
+
+    def clear(self, frame_class):
+        """Deletes every hour."""
+        backend = backends.get_backend()
+        for hour in backend.get_state(self.index_name(frame_class)):
+            backend.delete_state(self.state_name(frame_class, hour))
+        backend.delete_state(self.index_name(frame_class))
+        self._latest.pop(frame_class._meta.db_table, None)
+
+
+def _cutoff(hour):
+    """The earliest hour to keep, when hour is the latest."""
+    if settings.STATS_RETENTION is None:
+        return ''
+    latest = datetime.datetime.strptime(hour, HOUR_FORMAT)
+    return (latest - datetime.timedelta(seconds=settings.STATS_RETENTION)).strftime(HOUR_FORMAT)
+
+
+_hours = HourlyState('stats')
+
+
+def record(frame, timings, rows=None):
+    """
+    Adds the stage timings (a dict of stage -> seconds)
+    and row count for an analyzed frame to its histogram.
+    """
+    frame_class = type(frame)
+    hour = _hour(frame.start_time)
+
+    amounts = {'frames': 1}
+    for stage in STAGES:
+        seconds = timings.get(stage)
+        if seconds is None:
+            continue
+        amounts['%s:%d' % (stage, _bucket(seconds))] = 1
+        amounts['%s.count' % stage] = 1
+        amounts['%s.sum' % stage] = int(round(seconds * 1e6))
+
+    if rows is not None:
+        busy = sum(timings.get(stage) or 0 for stage in BUSY_STAGES)
+        amounts['rows'] = rows
+        amounts['rows.busy'] = int(round(busy * 1e6))
+
+    backend = backends.get_backend()
+    if _hours.add_hour(frame_class, hour):
+        backend.increment_state(_hours.state_name(frame_class, hour), amounts)
+    backend.increment_state(_hours.state_name(frame_class, TOTAL), amounts)
+
+
+def get_totals(frame_class):
+    """
+    Returns the running totals for the frame class, a dict with
+    frames, rows, and rows.busy (microseconds spent on frames with a row count),
+    and for each stage, stage.count, stage.sum (in microseconds)
+    and a stage:bucket count for each bucket (see get_buckets).
+    """
+    state = backends.get_backend().get_state(_hours.state_name(frame_class, TOTAL))
+    return dict((key, int(value)) for key, value in state.iteritems())
+
+
+def get_buckets(totals, stage):
+    """Returns a dict of bucket -> count for a stage from a dict of totals."""
+    prefix = stage + ':'
+    return dict((int(key[len(prefix):]), value)
+                for key, value in totals.iteritems() if key.startswith(prefix))
+
+
+def get_ladder(buckets):
+    """
+    Returns a list of (upper bound, cumulative count) for every bucket
+    in LADDER, from a dict of bucket -> count. Times over the last
+    upper bound are left out, so they are only in the total count.
+    """
+    ladder = []
+    seen = 0
+    remaining = sorted(buckets.iteritems())
+    for rung in LADDER:
+        while remaining and remaining[0][0] <= rung:
+            seen += remaining.pop(0)[1]
+        # Exactly a power of 2
+        ladder.append((2.0 ** ((rung + 1) // 4), seen))
+    return ladder
+
+
+def _percentile(buckets, count, percentile):
+    """Finds a percentile in a dict of bucket -> count."""
+    needed = count * percentile / 100.0
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen >= needed:
+            return _bucket_value(bucket)
+
+
+def summarize(frame_class, start=None, end=None):
+    """
+    Combines the histograms for frames that started
+    in the hours overlapping start and end,
+    or returns the running totals if neither is given.
+
+    Returns a dict with an entry for each stage, holding its
+    count, mean and p50, p95 and p99 times in seconds,
+    plus the total rows and rows processed per second.
+    """
+    if start is None and end is None:
+        totals = get_totals(frame_class)
+    else:
+        backend = backends.get_backend()
+        totals = {}
+        for hour in _hours.get_hours(frame_class, start, end):
+            for key, value in backend.get_state(_hours.state_name(frame_class, hour)).iteritems():
+                totals[key] = totals.get(key, 0) + int(value)
+
+    result = {
+        'frames': totals.get('frames', 0),
+        'rows': totals.get('rows', 0),
+        'rows_per_second': None,
+    }
+
+    if totals.get('rows.busy'):
+        result['rows_per_second'] = totals.get('rows', 0) / (totals['rows.busy'] / 1e6)
+
+    for stage in STAGES:
+        count = totals.get('%s.count' % stage, 0)
+        stage_stats = {'count': count, 'mean': None}
+        for percentile in PERCENTILES:
+            stage_stats['p%d' % percentile] = None
+
+        if count:
+            stage_stats['mean'] = totals.get('%s.sum' % stage, 0) / 1e6 / count
+
+            buckets = get_buckets(totals, stage)
+            for percentile in PERCENTILES:
+                stage_stats['p%d' % percentile] = _percentile(buckets, count, percentile)
+
+        result[stage] = stage_stats
+
+    return result
+
+
+def clear(frame_class):
+    """Forgets all of the histograms for the frame class."""
+    _hours.clear(frame_class)
+    backends.get_backend().delete_state(_hours.state_name(frame_class, TOTAL))
@@ -14,9 +14,47 @@ class AbstractStream(object):
         raise NotImplemented
 
     def get_stream_data(self, start, end):
-        """Returns stream data between start datetime and end datetime."""
+        """
+        Returns stream data between start datetime and end datetime.
+
+        For PartitionedTimeFrame classes, this is also given
+        a partition keyword argument, and should return only
+        the stream data in that partition.
+        """
         raise NotImplemented
 
+    def iter_stream_data(self, start, end, chunk_size):
+        """
+        Yields the stream data between start datetime and end datetime
+        in chunks of at most chunk_size items.
+
+        Optional. If implemented, and the time frame implements
+        calculate_incremental(), frames are analyzed in bounded memory.
+        Like get_stream_data(), it is given the partition of partitioned frames.
+        """
+        raise NotImplementedError
+
+    def get_stream_columns(self, start, end, fields):
+        """
+        Returns the given fields of the stream data between start datetime
+        and end datetime as a StreamBatch, which is quick to build with
+        StreamBatch.from_queryset(queryset, fields, time_field).
+
+        Optional. If implemented, time frames that set STREAM_COLUMNS
+        receive a StreamBatch in calculate() instead of get_stream_data().
+        Like get_stream_data(), it is given the partition of partitioned frames.
+        """
+        raise NotImplementedError
+
+    def get_stream_item_time(self, item):
+        """
+        Returns the datetime of an item from get_stream_data().
+
+        Optional. If implemented, batches of frames (see the batch_size
+        task setting) share a single get_stream_data() query.
+        """
+        raise NotImplementedError
+
     def delete_before(self, cutoff_datetime):
         """
         Delete analyzed stream data older than cutoff_datetime.
@@ -24,6 +62,17 @@ class AbstractStream(object):
         """
         return 0
 
+    def delete_batch_before(self, cutoff_datetime, batch_size):
+        """
+        Delete up to batch_size items of analyzed stream data
+        older than cutoff_datetime, oldest first.
+        Returns the amount of data deleted.
+
+        The default implementation deletes everything at once
+        with delete_before(). Override it to delete in small chunks.
+        """
+        return self.delete_before(cutoff_datetime)
+
     def count_before(self, cutoff_datetime):
         """
         Counts the amount of stream data older than cutoff_datetime.
@@ -0,0 +1,594 @@
+import datetime
+import threading
+import time
+
+from django.db import models as db_models, transaction
+from django.test import SimpleTestCase, TestCase
+from stream_analysis import backends, backfill, columns, frame_cache, heartbeats, models, profiling, settings, stats, streams, utils, watermarks
+
+
+class ExampleStreamItem(db_models.Model):
+    created_at = db_models.DateTimeField(db_index=True)
+    value = db_models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'stream_analysis'
+
+
+class ExampleStream(streams.AbstractStream):
+    """A stream of ExampleStreamItems."""
+
+    def is_stream_empty(self):
+        return not ExampleStreamItem.objects.exists()
+
+    def get_earliest_stream_time(self):
+        return ExampleStreamItem.objects.aggregate(earliest=db_models.Min('created_at'))['earliest']
+
+    def get_latest_stream_time(self):
+        return ExampleStreamItem.objects.aggregate(latest=db_models.Max('created_at'))['latest']
+
+    def get_stream_data(self, start, end):
+        return ExampleStreamItem.objects.filter(created_at__gte=start, created_at__lt=end).order_by('created_at')
+
+    def get_stream_item_time(self, item):
+        return item.created_at
+
+
+class ExampleTimeFrame(models.BaseTimeFrame):
+    DURATION = datetime.timedelta(minutes=1)
+    STREAM_CLASS = ExampleStream
+
+    item_count = db_models.IntegerField(default=0)
+
+    class Meta(models.BaseTimeFrame.Meta):
+        app_label = 'stream_analysis'
+
+    def calculate(self, stream_data):
+        self.item_count = len(stream_data)
+
+
+START = datetime.datetime(2014, 1, 1)
+
+
+def minutes(count):
+    return datetime.timedelta(minutes=count)
+
+
+class RecordingBackend(backends.LocalBackend):
+    """A local backend that runs jobs immediately, and records delayed jobs instead of running them."""
+
+    def __init__(self):
+        super(RecordingBackend, self).__init__()
+        self.workers = 0
+        self.delayed = []
+
+    def enqueue_in(self, delay, func, kwargs=None, meta=None):
+        self.delayed.append((delay, kwargs, meta))
+
+
+class FakeTask(object):
+    name = 'example'
+    key = 'example'
+    max_retries = 1
+    retry_backoff = 10
+
+    @staticmethod
+    def get_frame_class():
+        return ExampleTimeFrame
+
+
+class FakeFrameClass(object):
+    """Stands in for a time frame class, with the committed uncalculated start times in a list."""
+
+    class _meta:
+        db_table = 'fake_time_frames'
+
+    DURATION = datetime.timedelta(minutes=1)
+
+    uncalculated = []
+
+    @classmethod
+    def get_earliest_uncalculated_start_time(cls, exclude_ids=None):
+        return min(cls.uncalculated) if cls.uncalculated else None
+
+
+class FakeFrame(FakeFrameClass):
+
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.calculated = False
+
+    @classmethod
+    def get_result_field_names(cls):
+        return []
+
+    def save(self, update_fields=None):
+        pass
+
+    def mark_done(self):
+        models.BaseTimeFrame.mark_done.__func__(self)
+
+
+class AfterCommitTest(SimpleTestCase):
+
+    def setUp(self):
+        self.old_backend = backends._backend
+        backends._backend = backends.LocalBackend()
+
+    def tearDown(self):
+        backends._backend = self.old_backend
+
+    def test_watermark_read_before_commit(self):
+        start = datetime.datetime(2014, 1, 1)
+        times = [start + datetime.timedelta(minutes=minute) for minute in range(3)]
+        FakeFrame.uncalculated = list(times)
+        self.assertEqual(watermarks.get(FakeFrame, watermarks.EARLIEST_UNCALCULATED), times[0])
+
+        with models.after_commit():
+            for start_time in times[:2]:
+                FakeFrame(start_time).mark_done()
+
+                # Another process reads the watermark before the batch commits
+                self.assertEqual(watermarks.get(FakeFrame, watermarks.EARLIEST_UNCALCULATED), times[0])
+
+            # The batch commits
+            FakeFrame.uncalculated = times[2:]
+
+        self.assertEqual(watermarks.get(FakeFrame, watermarks.EARLIEST_UNCALCULATED), times[2])
+
+    def test_rolled_back_batch_leaves_watermark(self):
+        start = datetime.datetime(2014, 1, 1)
+        FakeFrame.uncalculated = [start]
+        self.assertEqual(watermarks.get(FakeFrame, watermarks.EARLIEST_UNCALCULATED), start)
+
+        with self.assertRaises(ValueError):
+            with models.after_commit():
+                FakeFrame(start).mark_done()
+                raise ValueError()
+
+        self.assertIsNone(models._pending.callbacks)
+        self.assertEqual(watermarks.get(FakeFrame, watermarks.EARLIEST_UNCALCULATED), start)
+
+    def test_frame_cache_bumped_after_commit(self):
+        old_frame_cache = settings.FRAME_CACHE
+        settings.FRAME_CACHE = 'local'
+        try:
+            frame = FakeFrame(datetime.datetime(2014, 1, 1))
+            state_name = frame_cache._state_name(FakeFrame)
+
+            with models.after_commit():
+                frame.mark_done()
+
+                # A reader caching the bucket now would not see the frame
+                self.assertEqual(backends.get_backend().get_state(state_name), {})
+
+            self.assertEqual(len(backends.get_backend().get_state(state_name)), 1)
+        finally:
+            settings.FRAME_CACHE = old_frame_cache
+
+
+class SplitStreamDataTest(TestCase):
+
+    def test_items_go_to_the_frame_they_start_in(self):
+        frames = [ExampleTimeFrame(start_time=START + minutes(i)) for i in (0, 1, 3)]
+        times = [
+            START - datetime.timedelta(seconds=1),                  # before every frame
+            START,                                                  # at the start of the first
+            START + minutes(1) - datetime.timedelta(microseconds=1),  # at the end of the first
+            START + minutes(1),                                     # at the start of the second
+            START + minutes(2) + datetime.timedelta(seconds=30),    # in the gap
+            START + minutes(3) + datetime.timedelta(seconds=59),    # in the last
+            START + minutes(4),                                     # after every frame
+        ]
+        items = [ExampleStreamItem(created_at=value) for value in times]
+
+        frame_data = utils._split_stream_data(ExampleStream(), items, frames)
+
+        self.assertEqual([[item.created_at for item in data] for data in frame_data],
+                         [times[1:3], times[3:4], times[5:6]])
+
+    def test_frames_of_different_durations(self):
+        class HourFrame(ExampleTimeFrame):
+            DURATION = datetime.timedelta(hours=1)
+
+            class Meta:
+                proxy = True
+                app_label = 'stream_analysis'
+
+        frames = [ExampleTimeFrame(start_time=START + minutes(30)), HourFrame(start_time=START)]
+        items = [ExampleStreamItem(created_at=START + minutes(value)) for value in (10, 30, 59)]
+
+        frame_data = utils._split_stream_data(ExampleStream(), items, frames)
+
+        self.assertEqual([len(data) for data in frame_data], [1, 3])
+
+
+class ClaimFramesTest(TestCase):
+
+    def setUp(self):
+        self.frames = [ExampleTimeFrame.objects.create(start_time=START + minutes(i)) for i in range(3)]
+        self.ids = [frame.pk for frame in self.frames]
+
+    def test_claims_are_exclusive(self):
+        first = ExampleTimeFrame.claim_frames(self.ids[:2])
+        second = ExampleTimeFrame.claim_frames(self.ids[1:])
+
+        self.assertEqual([frame.pk for frame in first], self.ids[:2])
+        self.assertEqual([frame.pk for frame in second], self.ids[2:])
+        self.assertEqual(ExampleTimeFrame.claim_frames(self.ids), [])
+
+    def test_claims_at_the_same_time_are_exclusive(self):
+        class StoppedClock(object):
+            @staticmethod
+            def time():
+                return 1000.0
+
+        old_time = models.time
+        models.time = StoppedClock
+        try:
+            first = ExampleTimeFrame.claim_frames(self.ids[:2])
+            second = ExampleTimeFrame.claim_frames(self.ids)
+        finally:
+            models.time = old_time
+
+        self.assertEqual([frame.pk for frame in first], self.ids[:2])
+        self.assertEqual([frame.pk for frame in second], self.ids[2:])
+
+    def test_skips_calculated_frames(self):
+        ExampleTimeFrame.objects.filter(pk=self.ids[0]).update(calculated=True)
+
+        claimed = ExampleTimeFrame.claim_frames(self.ids)
+
+        self.assertEqual([frame.pk for frame in claimed], self.ids[1:])
+        self.assertTrue(all(frame._analysis_started for frame in claimed))
+
+
+class InsertFramesTest(TestCase):
+
+    def test_new_frames_get_their_own_ids(self):
+        # An older frame that happens to share a start time
+        old = ExampleTimeFrame.objects.create(start_time=START, calculated=True)
+
+        frames = [ExampleTimeFrame(start_time=START + minutes(i)) for i in range(3)]
+        utils._insert_frames(ExampleTimeFrame, frames)
+
+        self.assertNotIn(old.pk, [frame.pk for frame in frames])
+        for frame in frames:
+            saved = ExampleTimeFrame.objects.get(pk=frame.pk)
+            self.assertEqual(saved.start_time, frame.start_time)
+            self.assertFalse(saved.calculated)
+
+
+class ReapStuckFramesTest(TestCase):
+
+    def setUp(self):
+        self.old_backend = backends._backend
+        self.backend = backends._backend = RecordingBackend()
+
+    def tearDown(self):
+        backends._backend = self.old_backend
+
+    def expire(self, frames):
+        heartbeat = heartbeats.Heartbeat(frames, -1)
+        heartbeat.beat()
+
+    def test_stuck_frames_are_retried_then_dead(self):
+        frame = ExampleTimeFrame.objects.create(start_time=START)
+        frame_class = ExampleTimeFrame
+
+        claimed = frame_class.claim_frames([frame.pk])
+        self.expire(claimed)
+        utils._reap_stuck_frames(FakeTask, frame_class)
+
+        self.assertIsNone(frame_class.objects.get(pk=frame.pk).analysis_time)
+        self.assertEqual([(delay, meta) for delay, kwargs, meta in self.backend.delayed],
+                         [(10, {'analysis.task.key': 'example', 'analysis.frame.id': frame.pk})])
+        self.assertEqual(heartbeats.get_expired(frame_class), [])
+
+        claimed = frame_class.claim_frames([frame.pk])
+        self.expire(claimed)
+        utils._reap_stuck_frames(FakeTask, frame_class)
+
+        self.assertEqual(len(self.backend.delayed), 1)
+        self.assertEqual(heartbeats.get_dead(frame_class).keys(), [str(frame.pk)])
+        self.assertIsNotNone(frame_class.objects.get(pk=frame.pk).analysis_time)
+
+    def test_calculated_frames_are_not_retried(self):
+        frame = ExampleTimeFrame.objects.create(start_time=START)
+
+        claimed = ExampleTimeFrame.claim_frames([frame.pk])
+        self.expire(claimed)
+        ExampleTimeFrame.objects.filter(pk=frame.pk).update(calculated=True)
+        utils._reap_stuck_frames(FakeTask, ExampleTimeFrame)
+
+        self.assertEqual(self.backend.delayed, [])
+
+
+class ClearQueuedTest(SimpleTestCase):
+
+    def test_cancels_only_the_task_jobs_not_started(self):
+        old_workers = settings.LOCAL_WORKERS
+        settings.LOCAL_WORKERS = 1
+        try:
+            backend = backends.LocalBackend()
+        finally:
+            settings.LOCAL_WORKERS = old_workers
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        running = backend.enqueue(block, meta={'analysis.task.key': 'example'})
+        started.wait(5)
+        queued = backend.enqueue(time.sleep, args=(0,), meta={'analysis.task.key': 'example', 'analysis.frame.id': 1})
+        other = backend.enqueue(time.sleep, args=(0,), meta={'analysis.task.key': 'other'})
+
+        try:
+            self.assertEqual(backend.clear_queued('example'), [queued.meta])
+        finally:
+            release.set()
+
+        other.future.result(5)
+        self.assertTrue(queued.future.cancelled())
+        self.assertFalse(running.future.cancelled())
+
+
+class BackfillTest(TestCase):
+
+    def setUp(self):
+        self.old_backend = backends._backend
+        backends._backend = RecordingBackend()
+
+        # Queue nothing, only insert the frames
+        self.old_insert_and_queue = utils._insert_and_queue
+        utils._insert_and_queue = lambda task, frames, queue=None: utils._insert_frames(type(frames[0]), frames)
+
+        ExampleStreamItem.objects.create(created_at=START)
+        ExampleTimeFrame.objects.create(start_time=START + minutes(10))
+
+    def tearDown(self):
+        backends._backend = self.old_backend
+        utils._insert_and_queue = self.old_insert_and_queue
+
+    def get_start_times(self):
+        return list(ExampleTimeFrame.objects.order_by('start_time').values_list('start_time', flat=True))
+
+    def test_backfills_back_to_the_stream(self):
+        self.assertEqual(backfill.Backfill(FakeTask).run(chunk_size=3), 10)
+        self.assertEqual(self.get_start_times(), [START + minutes(i) for i in range(11)])
+        self.assertIsNone(backfill.Backfill(FakeTask).get_progress())
+
+    def test_resumes_after_a_chunk_without_saved_progress(self):
+        job = backfill.Backfill(FakeTask)
+        job.run_chunk(3)
+
+        # Die between inserting the next chunk and saving its progress
+        def die(*args):
+            raise KeyboardInterrupt()
+        job._save_progress = die
+        with self.assertRaises(KeyboardInterrupt):
+            job.run_chunk(3)
+
+        job = backfill.Backfill(FakeTask)
+        self.assertEqual(job.run(chunk_size=3), 4)
+        self.assertEqual(self.get_start_times(), [START + minutes(i) for i in range(11)])
+
+
+class CatchUpTask(FakeTask):
+    CATCH_UP = 'catch_up'
+    catch_up_batch_size = 5
+
+    @classmethod
+    def get_mode(cls):
+        return cls.CATCH_UP
+
+
+class CatchUpFrameIdsTest(TestCase):
+
+    def setUp(self):
+        self.ids = dict((i, ExampleTimeFrame.objects.create(start_time=START + minutes(i)).pk)
+                        for i in (0, 1, 2, 3, 5, 6))
+
+    def test_adds_only_the_following_frames_up_to_a_gap(self):
+        self.assertEqual(utils._catch_up_frame_ids(CatchUpTask, ExampleTimeFrame, [self.ids[1]]),
+                         [self.ids[1], self.ids[2], self.ids[3]])
+
+    def test_skips_claimed_frames(self):
+        ExampleTimeFrame.claim_frames([self.ids[2]])
+        self.assertEqual(utils._catch_up_frame_ids(CatchUpTask, ExampleTimeFrame, [self.ids[0]]),
+                         [self.ids[0], self.ids[1]])
+
+    def test_caps_the_span(self):
+        old_span = settings.SHARED_FETCH_MAX_SPAN
+        settings.SHARED_FETCH_MAX_SPAN = 120
+        try:
+            self.assertEqual(utils._catch_up_frame_ids(CatchUpTask, ExampleTimeFrame, [self.ids[0]]),
+                             [self.ids[0], self.ids[1]])
+        finally:
+            settings.SHARED_FETCH_MAX_SPAN = old_span
+
+    def test_consecutive_frames(self):
+        frames = list(ExampleTimeFrame.objects.order_by('start_time'))
+        self.assertTrue(utils._is_consecutive(frames[:4]))
+        self.assertFalse(utils._is_consecutive(frames[3:5]))
+
+
+class StatsRetentionTest(SimpleTestCase):
+
+    def setUp(self):
+        self.old_backend = backends._backend
+        backends._backend = backends.LocalBackend()
+        self.old_retention = settings.STATS_RETENTION
+        settings.STATS_RETENTION = 2 * 3600
+        stats.clear(FakeFrame)
+
+    def tearDown(self):
+        stats.clear(FakeFrame)
+        backends._backend = self.old_backend
+        settings.STATS_RETENTION = self.old_retention
+
+    def record(self, hours):
+        stats.record(FakeFrame(START + datetime.timedelta(hours=hours)), {'fetch': 0.1}, rows=10)
+
+    def test_old_hours_are_dropped_but_totals_kept(self):
+        for hours in (0, 1, 2, 3, 0):
+            self.record(hours)
+
+        self.assertEqual(stats._hours.get_hours(FakeFrame), ['2014010101', '2014010102', '2014010103'])
+        self.assertEqual(backends.get_backend().get_state(stats._hours.state_name(FakeFrame, '2014010100')), {})
+        self.assertEqual(stats.get_totals(FakeFrame)['frames'], 5)
+
+        self.assertEqual(stats.summarize(FakeFrame)['frames'], 5)
+        self.assertEqual(stats.summarize(FakeFrame, start=START)['frames'], 3)
+        self.assertEqual(stats.summarize(FakeFrame, start=START + datetime.timedelta(hours=2),
+                                         end=START + datetime.timedelta(hours=3))['rows'], 10)
+
+    def test_old_profiles_are_dropped(self):
+        class Profile(object):
+            peak_memory = 100
+
+            def get_functions(self):
+                return []
+
+        for hours in (0, 3, 1):
+            frame = FakeFrame(START + datetime.timedelta(hours=hours))
+            frame.pk = hours
+            profiling.save(frame, Profile())
+
+        try:
+            self.assertEqual([profile['start_time'] for profile in profiling.get_profiles(FakeFrame)],
+                             [START + datetime.timedelta(hours=hours) for hours in (1, 3)])
+        finally:
+            profiling.clear(FakeFrame)
+
+
+class AnalyzeStatsTest(TestCase):
+
+    def setUp(self):
+        self.old_backend = backends._backend
+        backends._backend = backends.LocalBackend()
+
+    def tearDown(self):
+        stats.clear(ExampleTimeFrame)
+        backends._backend = self.old_backend
+
+    def analyze(self, fail=False):
+        frames = ExampleTimeFrame.claim_frames([self.frame.pk])
+        with models.after_commit(), transaction.atomic():
+            utils._analyze(frames[0], [1, 2, 3])
+            if fail:
+                raise ValueError()
+
+    def test_rolled_back_batch_is_counted_once(self):
+        self.frame = ExampleTimeFrame.objects.create(start_time=START)
+
+        with self.assertRaises(ValueError):
+            self.analyze(fail=True)
+        self.assertEqual(stats.get_totals(ExampleTimeFrame), {})
+
+        ExampleTimeFrame.objects.filter(pk=self.frame.pk).update(analysis_time=None)
+        self.analyze()
+        totals = stats.get_totals(ExampleTimeFrame)
+        self.assertEqual((totals['frames'], totals['rows']), (1, 3))
+
+
+class FrameCacheGenerationsTest(SimpleTestCase):
+
+    def setUp(self):
+        self.old_backend = backends._backend
+        backends._backend = backends.LocalBackend()
+        self.old_frame_cache = settings.FRAME_CACHE
+        settings.FRAME_CACHE = 'local'
+
+    def tearDown(self):
+        backends._backend = self.old_backend
+        settings.FRAME_CACHE = self.old_frame_cache
+
+    def get_state(self):
+        return backends.get_backend().get_state(frame_cache._state_name(FakeFrame))
+
+    def test_generations_never_repeat(self):
+        frame = FakeFrame(START)
+        generations = set()
+        for _ in range(3):
+            frame_cache.frame_changed(frame)
+            generations.add(self.get_state()[str(frame_cache._bucket_start(FakeFrame, START))])
+        self.assertEqual(len(generations), 3)
+
+    def test_old_generations_are_dropped(self):
+        frame_cache.frame_changed(FakeFrame(START))
+        time.sleep(0.01)
+        before = time.time()
+        time.sleep(0.01)
+        frame_cache.frame_changed(FakeFrame(START + datetime.timedelta(hours=1)))
+
+        frame_cache._prune(FakeFrame, before)
+
+        self.assertEqual(self.get_state().keys(),
+                         [str(frame_cache._bucket_start(FakeFrame, START + datetime.timedelta(hours=1)))])
+
+    def test_clear_drops_the_generations(self):
+        frame_cache.frame_changed(FakeFrame(START))
+        epoch = self.get_state().get('epoch')
+
+        frame_cache.clear(FakeFrame)
+
+        self.assertEqual(self.get_state().keys(), ['epoch'])
+        self.assertNotEqual(self.get_state()['epoch'], epoch)
+
+    def test_local_entries_expire(self):
+        cache = frame_cache.LRUCache(10)
+        cache.set_many({'fresh': 1}, 60)
+        cache.set_many({'stale': 2}, -1)
+        self.assertEqual(cache.get_many(['fresh', 'stale']), {'fresh': 1})
+
+
+class CountingColumnsStream(ExampleStream):
+    """Counts its get_stream_columns() queries."""
+
+    time_field = None
+    queries = 0
+
+    def get_stream_columns(self, start, end, fields):
+        type(self).queries += 1
+        items = ExampleStreamItem.objects.filter(created_at__gte=start, created_at__lt=end)
+        return columns.StreamBatch.from_queryset(items, fields, time_field=self.time_field)
+
+
+class TimedColumnsStream(CountingColumnsStream):
+    time_field = 'created_at'
+
+
+class ColumnsTimeFrame(ExampleTimeFrame):
+    STREAM_COLUMNS = ('value',)
+
+    class Meta:
+        proxy = True
+        app_label = 'stream_analysis'
+
+
+class FetchColumnsTest(TestCase):
+
+    def setUp(self):
+        for i in range(4):
+            ExampleStreamItem.objects.create(created_at=START + minutes(i), value=i)
+        self.frames = [ColumnsTimeFrame(start_time=START + minutes(i)) for i in range(4)]
+        utils._columns_split.clear()
+
+    def fetch(self, stream_class):
+        stream_class.queries = 0
+        values = [list(batch['value']) for batch in utils._fetch_columns(stream_class(), self.frames)]
+        self.assertEqual(values, [[0], [1], [2], [3]])
+        return stream_class.queries
+
+    def test_batches_with_a_time_field_share_a_query(self):
+        # The first time, the first frame is fetched on its own to find out
+        self.assertEqual(self.fetch(TimedColumnsStream), 2)
+        self.assertEqual(self.fetch(TimedColumnsStream), 1)
+
+    def test_batches_without_a_time_field_are_fetched_once(self):
+        self.assertEqual(self.fetch(CountingColumnsStream), 4)
+        self.assertEqual(self.fetch(CountingColumnsStream), 4)
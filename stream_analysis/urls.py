@@ -0,0 +1,6 @@
+from django.conf.urls import url
+from views import metrics_view
+
+urlpatterns = [
+    url(r'^metrics$', metrics_view, name='stream_analysis_metrics'),
+]
@@ -4,29 +4,82 @@ functions for executing scheduled analysis work
 based on the settings in ANALYSIS_TIME_FRAME_TASKS.
 """
 
+import collections
 import datetime
 import logging
+import os
+import sys
+import time
+import uuid
 
 import re
 from django.utils import importlib, timezone
-from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models.query import QuerySet
+import backends
+import heartbeats
+import metrics
+import models
+import profiling
 import settings
-import django_rq
-from rq import get_current_job
+import stats
+import streams
+import watermarks
 
 logger = logging.getLogger('stream_analysis')
-scheduler = django_rq.get_scheduler()
+
+# When this worker process, or the parent it was forked from, loaded us.
+# Modules that were already loaded elsewhere are assumed to be this old.
+_started_at = time.time()
+
+# Source modification times of the modules loaded by _import_attribute.
+_module_mtimes = {}
+
+
+def _get_source_mtime(module):
+    """Returns the modification time of a module's source file, or None."""
+    path = getattr(module, '__file__', None)
+    if not path:
+        return None
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
 
 
 def _import_attribute(name, reload_module=False):
-    """Return an attribute from a dotted path name (e.g. "path.to.func")."""
+    """
+    Return an attribute from a dotted path name (e.g. "path.to.func").
+
+    If reload_module is True, the module is reloaded only
+    when its source file has changed since it was loaded.
+    """
     module_name, attribute = name.rsplit('.', 1)
+    already_loaded = module_name in sys.modules
     module = importlib.import_module(module_name)
-    if reload_module:
-        reload(module)
+
+    if not already_loaded:
+        _module_mtimes[module_name] = _get_source_mtime(module)
+    elif reload_module:
+        mtime = _get_source_mtime(module)
+        loaded_mtime = _module_mtimes.get(module_name) or _started_at
+        if mtime is not None and mtime > loaded_mtime:
+            logger.info("Reloading changed module %s", module_name)
+            reload(module)
+            _module_mtimes[module_name] = mtime
+
     return getattr(module, attribute)
 
 
+def _implements(obj, base_class, method_name):
+    """True if obj overrides the named method of base_class."""
+    method = getattr(type(obj), method_name, None)
+    return getattr(method, '__func__', method) is not getattr(base_class, method_name).__func__
+
+
 class AnalysisTask(object):
     """
     A class for representing, validating, and scheduling analysis tasks.
@@ -34,11 +87,29 @@ class AnalysisTask(object):
     TASK_KEY_REGEX = re.compile('\w+')
     _tasks_config = {}
 
+    # Modes of operation
+    NORMAL = 'normal'
+    CATCH_UP = 'catch_up'
+
+    # Seconds a node may take to schedule a task
+    SCHEDULE_LEASE_TTL = 30
+
     def __init__(self, key, taskdef):
         self.key = key
         self.name = taskdef['name']
         self.frame_class_path = taskdef['frame_class_path']
         self.autostart = taskdef.get('autostart', False)
+        self.batch_size = taskdef.get('batch_size', 1)
+        self.chunk_size = taskdef.get('chunk_size', 1000)
+        self.stream_group = taskdef.get('stream_group')
+        self.catch_up_lag = taskdef.get('catch_up_lag')
+        self.catch_up_queue_depth = taskdef.get('catch_up_queue_depth')
+        self.catch_up_batch_size = taskdef.get('catch_up_batch_size', self.batch_size * 10)
+        self.profile_rate = taskdef.get('profile_rate', 0)
+        self.profile_top = taskdef.get('profile_top', 20)
+        self.frame_lease = taskdef.get('frame_lease', 300)
+        self.max_retries = taskdef.get('max_retries', 3)
+        self.retry_backoff = taskdef.get('retry_backoff', 60)
 
     def validate(self):
         """Verify the values from the settings file."""
@@ -50,40 +121,160 @@ class AnalysisTask(object):
         if not isinstance(self.name, basestring):
             raise ImproperlyConfigured("Name %s in ANALYSIS_TIME_FRAME_TASKS is not a string" % self.name)
 
+        if not isinstance(self.batch_size, (int, long)) or self.batch_size < 1:
+            raise ImproperlyConfigured("Batch size %s in ANALYSIS_TIME_FRAME_TASKS is not a positive integer" % self.batch_size)
+
+        if not isinstance(self.chunk_size, (int, long)) or self.chunk_size < 1:
+            raise ImproperlyConfigured("Chunk size %s in ANALYSIS_TIME_FRAME_TASKS is not a positive integer" % self.chunk_size)
+
+        if self.stream_group is not None and not isinstance(self.stream_group, basestring):
+            raise ImproperlyConfigured("Stream group %s in ANALYSIS_TIME_FRAME_TASKS is not a string" % self.stream_group)
+
+        if self.catch_up_lag is not None and (not isinstance(self.catch_up_lag, (int, long, float)) or self.catch_up_lag <= 0):
+            raise ImproperlyConfigured("Catch up lag %s in ANALYSIS_TIME_FRAME_TASKS is not a positive number" % self.catch_up_lag)
+
+        if self.catch_up_queue_depth is not None and (not isinstance(self.catch_up_queue_depth, (int, long)) or self.catch_up_queue_depth < 1):
+            raise ImproperlyConfigured("Catch up queue depth %s in ANALYSIS_TIME_FRAME_TASKS is not a positive integer" % self.catch_up_queue_depth)
+
+        if not isinstance(self.catch_up_batch_size, (int, long)) or self.catch_up_batch_size < 1:
+            raise ImproperlyConfigured("Catch up batch size %s in ANALYSIS_TIME_FRAME_TASKS is not a positive integer" % self.catch_up_batch_size)
+
+        if not isinstance(self.profile_rate, (int, long, float)) or not 0 <= self.profile_rate <= 1:
+            raise ImproperlyConfigured("Profile rate %s in ANALYSIS_TIME_FRAME_TASKS is not between 0 and 1" % self.profile_rate)
+
+        if not isinstance(self.profile_top, (int, long)) or self.profile_top < 1:
+            raise ImproperlyConfigured("Profile top %s in ANALYSIS_TIME_FRAME_TASKS is not a positive integer" % self.profile_top)
+
+        if not isinstance(self.frame_lease, (int, long, float)) or self.frame_lease <= 0:
+            raise ImproperlyConfigured("Frame lease %s in ANALYSIS_TIME_FRAME_TASKS is not a positive number" % self.frame_lease)
+
+        if not isinstance(self.max_retries, (int, long)) or self.max_retries < 0:
+            raise ImproperlyConfigured("Max retries %s in ANALYSIS_TIME_FRAME_TASKS is not a non-negative integer" % self.max_retries)
+
+        if not isinstance(self.retry_backoff, (int, long, float)) or self.retry_backoff < 0:
+            raise ImproperlyConfigured("Retry backoff %s in ANALYSIS_TIME_FRAME_TASKS is not a non-negative number" % self.retry_backoff)
 
     def get_frame_class(self):
         """Get the frame class for this analysis task"""
-        return _import_attribute(self.frame_class_path, reload_module=True)
+        return _import_attribute(self.frame_class_path, reload_module=settings.AUTO_RELOAD)
+
+    def _get_state_name(self):
+        return 'task:%s' % self.key
+
+    def get_lag(self):
+        """
+        Measures how far this task's analysis is behind.
+        Returns a tuple of (lag, queue_depth), where lag is the timedelta
+        between the calculated frames and the latest stream data, or None
+        if there is nothing to compare yet, and queue_depth is the number
+        of jobs waiting on the queue.
+        """
+        frame_class = self.get_frame_class()
+
+        if frame_class.is_rollup():
+            # Rollups are fed by their source frames, not the stream
+            high_water = frame_class.get_rollup_ready_time()
+        else:
+            high_water = watermarks.get(frame_class, watermarks.STREAM_LATEST)
+
+        calculated_until = watermarks.get(frame_class, watermarks.EARLIEST_UNCALCULATED)
+        if calculated_until is None:
+            calculated_until = watermarks.get(frame_class, watermarks.LATEST_END)
+
+        lag = None
+        if high_water is not None and calculated_until is not None:
+            lag = max(high_water - calculated_until, datetime.timedelta(0))
+
+        return lag, backends.get_backend().get_queue_depth()
+
+    def get_mode(self):
+        """Returns CATCH_UP while the task is working off a backlog, otherwise NORMAL."""
+        return backends.get_backend().get_state(self._get_state_name()).get('mode') or self.NORMAL
+
+    def get_status(self):
+        """
+        Returns a dict with the task's mode, and the lag (in seconds, or None)
+        and queue depth from the last time they were measured.
+        """
+        state = backends.get_backend().get_state(self._get_state_name())
+        return {
+            'mode': state.get('mode') or self.NORMAL,
+            'lag': float(state['lag']) if state.get('lag') else None,
+            'queue_depth': int(state.get('queue_depth') or 0),
+        }
+
+    def update_mode(self):
+        """
+        Measures the lag and switches the task into or out of catch-up mode.
+
+        Catch-up mode starts once the lag passes catch_up_lag seconds or
+        the queue depth passes catch_up_queue_depth, and ends once both
+        are back under half of those thresholds. Returns the new mode.
+        """
+        lag, queue_depth = self.get_lag()
+        lag_seconds = lag.total_seconds() if lag is not None else None
+
+        def behind(fraction):
+            if self.catch_up_lag is not None and lag_seconds is not None \
+                    and lag_seconds > self.catch_up_lag * fraction:
+                return True
+            return self.catch_up_queue_depth is not None and queue_depth > self.catch_up_queue_depth * fraction
+
+        mode = self.get_mode()
+        if mode != self.CATCH_UP and behind(1):
+            logger.warn("Task '%s' is %s behind with %d queued jobs, catching up", self.name, lag, queue_depth)
+            mode = self.CATCH_UP
+        elif mode == self.CATCH_UP and not behind(0.5):
+            logger.info("Task '%s' has caught up", self.name)
+            mode = self.NORMAL
+
+        backends.get_backend().update_state(self._get_state_name(), {
+            'mode': mode,
+            'lag': lag_seconds if lag_seconds is not None else '',
+            'queue_depth': queue_depth,
+        })
+        return mode
+
+    def get_batch_size(self):
+        """The number of frames to analyze per job in the current mode."""
+        if self.get_mode() == self.CATCH_UP:
+            return self.catch_up_batch_size
+        return self.batch_size
 
     def get_rq_job(self):
         """Get the job for scheduling analysis of this task."""
-        jobs = scheduler.get_jobs()
-        for job in jobs:
-            if job.meta.get('analysis.task.schedule') and job.meta.get('analysis.task.key') == self.key:
-                return job
+        return backends.get_backend().get_scheduled(self.key)
 
     def schedule(self, cancel_first=True, start_now=True):
-        """Schedule this analysis task."""
+        """
+        Schedule this analysis task.
 
-        if cancel_first:
-            # First cancel any old jobs
-            self.cancel()
+        Only one node can schedule a task at a time; returns False
+        if another node is scheduling it right now. Each schedule
+        gets a new token, and create_frames jobs from any older
+        schedule that is still around do nothing.
+        """
 
-        # Use the analysis duration as the interval
-        interval = self.get_frame_class().DURATION.total_seconds()
+        backend = backends.get_backend()
+        lease_name = 'schedule:%s' % self.key
+        token = str(uuid.uuid4())
+        if not backend.acquire_lease(lease_name, token, self.SCHEDULE_LEASE_TTL):
+            logger.info("Task '%s' is being scheduled by another node", self.name)
+            return False
 
-        now = datetime.datetime.now()
+        try:
+            if cancel_first:
+                # First cancel any old jobs
+                self.cancel()
 
-        job = scheduler.schedule(
-            scheduled_time=now,
-            interval=interval,
-            func=create_frames,
-            args=[self.key]
-        )
+            # Use the analysis duration as the interval
+            interval = self.get_frame_class().DURATION.total_seconds()
 
-        job.meta['analysis.task.key'] = self.key
-        job.meta['analysis.task.schedule'] = True
-        job.save()
+            backend.update_state(self._get_state_name(), {'schedule_token': token})
+            backend.schedule(self.key, create_frames, interval,
+                             {'task_key': self.key, 'schedule_token': token})
+        finally:
+            backend.release_lease(lease_name, token)
 
         logger.info("Scheduled task '%s' every %d seconds", self.name, interval)
 
@@ -92,44 +283,75 @@ class AnalysisTask(object):
 
         return True
 
-    def cancel(self):
-        """Stop this task."""
-        job = self.get_rq_job()
+    def get_schedule_token(self):
+        """Returns the token of the current schedule, or None."""
+        return backends.get_backend().get_state(self._get_state_name()).get('schedule_token') or None
 
-        if job:
-            scheduler.cancel(job)
-            job.delete()
+    def cancel(self):
+        """Stop this task, including any duplicate schedules."""
+        backend = backends.get_backend()
+        backend.update_state(self._get_state_name(), {'schedule_token': ''})
+        if backend.cancel_scheduled(self.key):
             logger.info("Cancelled task '%s'", self.name)
-
             return True
 
         return False
 
+    def get_dead_frames(self):
+        """Returns a dict of the ids of frames that ran out of retries -> their start times."""
+        return heartbeats.get_dead(self.get_frame_class())
+
+    def retry_dead_frames(self):
+        """Releases the frames that ran out of retries, so they are analyzed again."""
+        frame_class = self.get_frame_class()
+        frame_ids = heartbeats.get_dead(frame_class).keys()
+        if not frame_ids:
+            return 0
+
+        heartbeats.forget_dead(frame_class, frame_ids)
+        frame_class.objects.filter(pk__in=frame_ids, calculated=False).update(analysis_time=None)
+        watermarks.invalidate(frame_class, watermarks.EARLIEST_UNCALCULATED)
+
+        queued_at = time.time()
+        backends.get_backend().enqueue_many([
+            (analyze_frame,
+             {'task_key': self.key, 'frame_id': int(frame_id), 'queued_at': queued_at},
+             {'analysis.task.key': self.key, 'analysis.frame.id': int(frame_id)})
+            for frame_id in frame_ids
+        ])
+        return len(frame_ids)
+
     def clear_queue(self):
         """Clear all queued analyze_frame jobs, and their corresponding frames"""
 
         frame_class = self.get_frame_class()
 
-        queue = django_rq.get_queue()
-        jobs = queue.get_jobs()
-        cleared = 0
+        cleared_metas = backends.get_backend().clear_queued(self.key)
+
+        # Deleting frames can move any of the watermarks
+        watermarks.invalidate(frame_class, *watermarks.WATERMARKS)
+
+        frame_ids = []
+        for meta in cleared_metas:
+            if meta.get('analysis.frame.ids'):
+                frame_ids.extend(meta['analysis.frame.ids'])
+            elif meta.get('analysis.frame.id'):
+                frame_ids.append(meta['analysis.frame.id'])
+
+        # Delete the corresponding frames all at once
         frames_deleted = 0
-        for job in jobs:
-            # Delete jobs for this task but not scheduler jobs
-            if (job.meta.get('analysis.task.key') == self.key) and not job.meta.get('analysis.task.schedule'):
-                cleared += 1
-                job.cancel()
-
-                frame_id = job.meta.get('analysis.frame.id')
-                if frame_id:
-                    # Delete the corresponding frame
-                    try:
-                        frame_class.objects.filter(pk=frame_id, calculated=False).delete()
-                        frames_deleted += 1
-                    except Exception as e:
-                        logger.warn(e, exc_info=True)
-
-        return cleared, frames_deleted
+        if frame_ids:
+            try:
+                # Frames claimed by a catch-up batch may have been calculated since
+                frames = frame_class.objects.filter(pk__in=frame_ids, calculated=False)
+                frames_deleted = frames.count()
+                frames.delete()
+            except Exception as e:
+                logger.warn(e, exc_info=True)
+
+        metrics.frames_cleared(frame_class, frames_deleted)
+
+        return len(cleared_metas), frames_deleted
 
     @classmethod
     def get(cls, key=None):
@@ -159,58 +381,216 @@ class AnalysisTask(object):
 # Functions for doing analysis
 ########################
 
-def _insert_and_queue(task_key, time_frames):
+def _insert_frames(frame_class, time_frames):
+    """
+    Inserts the given TimeFrames into the database with a single query.
+    Makes sure every frame has its primary key set.
+    """
+    frame_class.objects.bulk_create(time_frames)
+
+    if all(frame.pk is not None for frame in time_frames):
+        return time_frames
+
+    # Most databases don't report the new primary keys,
+    # so look them up again by start time (and any other key fields).
+    # Only untouched frames can be new, and if an older frame somehow
+    # has the same key, the highest primary key is the one just inserted.
+    frames_by_key = dict((frame.get_key(), frame) for frame in time_frames)
+    start_times = [frame.start_time for frame in time_frames]
+    saved = frame_class.objects \
+        .filter(start_time__gte=min(start_times), start_time__lte=max(start_times),
+                calculated=False, analysis_time__isnull=True) \
+        .order_by('pk') \
+        .values_list('pk', *frame_class.KEY_FIELDS)
+
+    for row in saved:
+        frame = frames_by_key.get(tuple(row[1:]))
+        if frame is not None:
+            frame.pk = row[0]
+
+    return time_frames
+
+
+def _insert_and_queue(task, time_frames, queue=None):
     """
     Inserts the given TimeFrames into the database
-    and creates a job to calculate each one.
+    and creates a job to calculate each one, on the given queue.
+
+    If the task's batch size (catch_up_batch_size in catch-up mode)
+    is more than 1, consecutive frames are grouped into analyze_frames
+    jobs of that size. Frames for different partitions get separate jobs.
+    If the task belongs to a stream group, analyze_stream_range
+    jobs are created instead, to share stream data with the
+    other tasks in the group.
     """
-    for frame in time_frames:
-        frame.save()
-        job = analyze_frame.delay(task_key=task_key, frame_id=frame.pk)
-        job.meta['analysis.task.key'] = task_key
-        job.meta['analysis.frame.id'] = frame.pk
-        job.save()
+    if not time_frames:
+        return
+
+    frame_class = type(time_frames[0])
+    _insert_frames(frame_class, time_frames)
+    watermarks.frames_inserted(frame_class, time_frames)
+    metrics.frames_created(frame_class, len(time_frames))
+
+    batch_size = task.get_batch_size()
+    shared = task.stream_group is not None and not frame_class.is_rollup() \
+        and not frame_class.is_partitioned()
+
+    batches = []
+    for frames in _group_by_partition(time_frames):
+        frames.sort(key=lambda frame: frame.start_time)
+        for i in range(0, len(frames), batch_size):
+            batches.append(frames[i:i + batch_size])
+
+    queued_at = time.time()
+    calls = []
+    for batch in batches:
+        if shared:
+            frame_ids = [frame.pk for frame in batch]
+            calls.append((
+                analyze_stream_range,
+                {'stream_group': task.stream_group,
+                 'start': min(frame.start_time for frame in batch),
+                 'end': max(frame.end_time for frame in batch),
+                 'queued_at': queued_at},
+                {'analysis.task.key': task.key, 'analysis.frame.ids': frame_ids},
+            ))
+        elif len(batch) == 1:
+            frame_id = batch[0].pk
+            calls.append((
+                analyze_frame,
+                {'task_key': task.key, 'frame_id': frame_id, 'queued_at': queued_at},
+                {'analysis.task.key': task.key, 'analysis.frame.id': frame_id},
+            ))
+        else:
+            frame_ids = [frame.pk for frame in batch]
+            calls.append((
+                analyze_frames,
+                {'task_key': task.key, 'frame_ids': frame_ids, 'queued_at': queued_at},
+                {'analysis.task.key': task.key, 'analysis.frame.ids': frame_ids},
+            ))
+    backends.get_backend().enqueue_many(calls, queue=queue)
+
+    logger.info("Created %d time frames in %d jobs", len(time_frames), len(calls))
+
 
-    if time_frames:
-        logger.info("Created %d time frames", len(time_frames))
+def _group_by_partition(frames):
+    """Divides frames into lists that share the same stream filter."""
+    groups = collections.OrderedDict()
+    for frame in frames:
+        key = tuple(sorted(frame.get_stream_filter().items()))
+        groups.setdefault(key, []).append(frame)
+    return groups.values()
 
 
-@django_rq.job
-def create_frames(task_key):
+@backends.job
+def create_frames(task_key, schedule_token=None):
     """
     Creates new time frames that are needed to analyze new stream data.
     Takes as input a task key from the ANALYSIS_TIME_FRAME_TASKS dict.
+    Scheduled jobs also pass the token of their schedule,
+    and do nothing unless it is the task's current schedule.
 
     It checks the time on the newest stream data and the newest frame.
     If there is room for new frames, it adds these.
 
-    For every new frame, an RQ job is created to analyze it.
+    For every new frame, a job is created to analyze it.
+    If the task has fallen behind, it switches to catch-up mode
+    and the new frames are analyzed in larger batches.
     """
 
-    me = get_current_job()
-    for job in django_rq.get_queue().get_jobs():
-        if job.get_call_string() == me.get_call_string() and job.id != me.id:
-            logger.info("Skipping duplicate create_frames job")
-            return
-
     # Get the stream interface
     task = AnalysisTask.get(key=task_key)
     frame_class = task.get_frame_class()
-    duration = frame_class.DURATION
-    stream = frame_class.STREAM_CLASS()
 
-    if stream.is_stream_empty():
-        logger.info("No data to analyze")
+    if schedule_token is not None and schedule_token != task.get_schedule_token():
+        logger.info("Skipping create_frames from an old or duplicate schedule of task '%s'", task.name)
         return
 
-    logger.info("Creating frames for %s", task.name)
+    # Only one create_frames per task may run in each half duration.
+    # Duplicates that piled up behind it in the queue will be skipped.
+    # The lease is renewed for as long as this run takes, so a slow run
+    # never overlaps the next one.
+    backend = backends.get_backend()
+    token = backend.get_current_job_id() or str(uuid.uuid4())
+    lease_name = 'create_frames:%s' % task_key
+    lease_ttl = frame_class.DURATION.total_seconds() / 2
+    if not backend.acquire_lease(lease_name, token, lease_ttl):
+        logger.info("Skipping duplicate create_frames job")
+        return
+
+    try:
+        with backends.LeaseKeeper(lease_name, token, lease_ttl):
+            task.update_mode()
+            _reap_stuck_frames(task, frame_class)
+            _create_frames(task, frame_class)
+    except:
+        # Let the next run try again right away
+        backend.release_lease(lease_name, token)
+        raise
 
-    new_time_frames = []
+
+def _reap_stuck_frames(task, frame_class):
+    """
+    Finds frames whose worker stopped sending heartbeats,
+    and queues them to be analyzed again after a backoff.
+    Frames that have been retried max_retries times are marked dead.
+    """
+    frame_ids = heartbeats.get_expired(frame_class)
+    if not frame_ids:
+        return
+
+    heartbeats.forget(frame_class, frame_ids)
+
+    backend = backends.get_backend()
+    for frame_id in frame_ids:
+        retries = heartbeats.add_retry(frame_class, frame_id)
+        if retries > task.max_retries:
+            # Leave it claimed so that nothing picks it up again
+            start_times = list(frame_class.objects.filter(pk=frame_id, calculated=False)
+                               .values_list('start_time', flat=True)[:1])
+            if start_times:
+                start_time = start_times[0]
+                logger.error("Giving up on %s frame #%s (%s) after %d retries",
+                             task.name, frame_id, start_time, task.max_retries)
+                heartbeats.mark_dead(frame_class, frame_id, start_time)
+                watermarks.invalidate(frame_class, watermarks.EARLIEST_UNCALCULATED)
+            continue
+
+        # Release the claim, unless it got calculated after all
+        if not frame_class.objects.filter(pk=frame_id, calculated=False).update(analysis_time=None):
+            continue
+
+        delay = task.retry_backoff * 2 ** (retries - 1)
+        logger.warn("Retrying stuck %s frame #%s in %d seconds (retry %d of %d)",
+                    task.name, frame_id, delay, retries, task.max_retries)
+        backend.enqueue_in(delay, analyze_frame,
+                           {'task_key': task.key, 'frame_id': int(frame_id), 'queued_at': time.time() + delay},
+                           {'analysis.task.key': task.key, 'analysis.frame.id': int(frame_id)})
+
+
+def _floor_time(value, duration):
+    """Rounds a datetime down to a multiple of duration since midnight."""
+    midnight = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    seconds = (value - midnight).total_seconds()
+    return midnight + datetime.timedelta(seconds=seconds - seconds % duration.total_seconds())
+
+
+def _create_frames(task, frame_class):
+    """Adds and queues any new time frames for the task."""
+    if frame_class.is_rollup():
+        return _create_rollup_frames(task, frame_class)
+
+    duration = frame_class.DURATION
+    stream = frame_class.STREAM_CLASS()
 
     # Get the most recent time frame.
     # We'll start analyzing after this.
-    latest_analyzed = frame_class.get_latest_end_time()
+    latest_analyzed = watermarks.get(frame_class, watermarks.LATEST_END)
     if latest_analyzed is None:
+        if stream.is_stream_empty():
+            logger.info("No data to analyze")
+            return
+
         # There are no frames, so we will start with the first stream item.
         latest_analyzed = stream.get_earliest_stream_time()
 
@@ -226,6 +606,12 @@ def create_frames(task_key):
         logger.info("No data to analyze")
         return
 
+    watermarks.record(frame_class, watermarks.STREAM_LATEST, latest_allowable_start)
+
+    logger.info("Creating frames for %s", task.name)
+
+    new_time_frames = []
+
     # but the frame can stop no later than this time so subtract the duration of the frame
     latest_allowable_start -= duration
 
@@ -236,92 +622,517 @@ def create_frames(task_key):
         logger.info("Analyzing from %s to %s", frame_start, latest_allowable_start)
 
     while frame_start < latest_allowable_start:
-        # Create a new global (no word) time frame
-        new_time_frames.append(frame_class(start_time=frame_start))
+        # Create the frames for this interval, one for each partition if partitioned
+        new_time_frames.extend(frame_class.make_frames(frame_start))
         frame_start += duration
 
-    _insert_and_queue(task_key, new_time_frames)
+    _insert_and_queue(task, new_time_frames)
 
 
-def backfill_tasks(task_key):
+def _create_rollup_frames(task, frame_class):
     """
-    Fills in any missing tasks for stream data older than the oldest
-    time frame for this task.
-
-    TODO: Make this not defective
+    Adds and queues any new rollup frames for the task.
+    A rollup frame is only added once all of the source
+    frames it would combine have been calculated.
     """
-
-    task = AnalysisTask.get(key=task_key)
-    frame_class = task.get_frame_class()
     duration = frame_class.DURATION
-    stream = frame_class.STREAM_CLASS()
+    source_class = frame_class.ROLLUP_SOURCE_CLASS
 
-    if stream.is_stream_empty():
-        logger.info("No data to analyze")
+    logger.info("Creating rollup frames for %s", task.name)
+
+    # Get the most recent rollup frame.
+    # We'll start combining after this.
+    latest_combined = watermarks.get(frame_class, watermarks.LATEST_END)
+    if latest_combined is None:
+        # There are no frames, so we will start with the first source frame.
+        latest_combined = source_class.get_earliest_start_time()
+
+        if latest_combined is None:
+            logger.info("No %s frames to combine", source_class.__name__)
+            return
+
+        latest_combined = _floor_time(latest_combined, duration)
+
+    # Rollup frames must end before the first unfinished source frame.
+    latest_allowable_start = frame_class.get_rollup_ready_time()
+    if latest_allowable_start is None:
+        logger.info("No %s frames to combine", source_class.__name__)
         return
 
-    logger.info("Backfilling frames for %s", task.name)
+    latest_allowable_start -= duration
 
-    # Done looking forwards, now look backwards
     new_time_frames = []
 
-    # Get the oldest stream data
-    # We'll start analysis here
-    earliest_allowable_start = stream.get_earliest_stream_time() - duration
-    if earliest_allowable_start is None:
-        logger.info("No data to analyze")
-        return
+    frame_start = latest_combined
+    while frame_start <= latest_allowable_start:
+        new_time_frames.extend(frame_class.make_frames(frame_start))
+        frame_start += duration
+
+    _insert_and_queue(task, new_time_frames)
+
+
+def backfill_tasks(task_key, max_rate=None):
+    """
+    Fills in any missing tasks for stream data older than the oldest
+    time frame for this task. See stream_analysis.backfill.
+    """
+    import backfill
+
+    task = AnalysisTask.get(key=task_key)
+    return backfill.Backfill(task).run(max_rate=max_rate)
+
+
+def _is_incremental(frame, stream):
+    """True if the frame can be analyzed one chunk of stream data at a time."""
+    return _implements(frame, models.BaseTimeFrame, 'calculate_incremental') and \
+        _implements(stream, streams.AbstractStream, 'iter_stream_data')
+
+
+def _uses_columns(frame, stream):
+    """True if the frame is analyzed with a StreamBatch of its STREAM_COLUMNS."""
+    return bool(type(frame).STREAM_COLUMNS) and not type(frame).is_rollup() and \
+        _implements(stream, streams.AbstractStream, 'get_stream_columns')
+
+
+# Whether the StreamBatches of each stream class have a time field, once known
+_columns_split = {}
+
+
+def _fetch_columns(stream, frames):
+    """
+    Returns a StreamBatch for each of the frames, fetched with a single query
+    if they are consecutive, share a partition and the batch has a time field.
+    Whether a stream's batches have a time field is found out from the first
+    frame fetched on its own, so a combined batch is never fetched in vain.
+    """
+    fields = type(frames[0]).STREAM_COLUMNS
+    stream_class = type(stream)
+
+    batches = []
+    if len(frames) > 1 and len(_group_by_partition(frames)) == 1 and _is_consecutive(frames):
+        if stream_class not in _columns_split:
+            first = frames[0]
+            batches.append(stream.get_stream_columns(first.start_time, first.end_time, fields,
+                                                     **first.get_stream_filter()))
+            _columns_split[stream_class] = batches[0].time_field is not None
+            frames = frames[1:]
+
+        if _columns_split[stream_class] and len(frames) > 1:
+            batch = stream.get_stream_columns(frames[0].start_time, frames[-1].end_time, fields,
+                                              **frames[0].get_stream_filter())
+            return batches + [batch.between(frame.start_time, frame.end_time) for frame in frames]
+
+    return batches + [stream.get_stream_columns(frame.start_time, frame.end_time, fields,
+                                                **frame.get_stream_filter())
+                      for frame in frames]
+
+
+def _evaluate(stream_data):
+    """
+    Runs the query of a lazy QuerySet right away, so that it is timed
+    as fetching and its items can be counted. calculate() would run it anyway.
+    """
+    if isinstance(stream_data, QuerySet) and stream_data._result_cache is None:
+        len(stream_data)
+    return stream_data
+
+
+def _count_rows(stream_data):
+    """The number of stream items, if it can be known without another query."""
+    if isinstance(stream_data, QuerySet):
+        if stream_data._result_cache is None:
+            return None
+        return len(stream_data._result_cache)
 
-    # Get the oldest time frame
-    # We'll stop analysis here
     try:
-        earliest = frame_class.get_earliest_start_time()
-    except ObjectDoesNotExist:
-        logger.info("No backfilling necessary.")
-        return
+        return len(stream_data)
+    except TypeError:
+        return None
+
+
+def _timed_chunks(chunks, timings):
+    """Yields the chunks, adding the time spent fetching them to timings['fetch']."""
+    chunks = iter(chunks)
+    while True:
+        started = time.time()
+        try:
+            chunk = _evaluate(next(chunks))
+        finally:
+            timings['fetch'] += time.time() - started
+        yield chunk
+
+
+def _analyze(frame, stream_data, incremental=False, fetch_time=0.0, queued_at=None, task=None):
+    """
+    Run a claimed frame through the rest of its analysis lifecycle.
+    If incremental is True, stream_data is an iterable of chunks.
+    For rollup frames, stream_data is the child frames.
+
+    The time taken by each stage is recorded with stream_analysis.stats,
+    including fetch_time, the time already spent fetching stream_data,
+    and the time since the frame's job was queued at queued_at.
+    A sample of the task's frames are profiled (see stream_analysis.profiling).
+    """
+
+    timings = {'fetch': fetch_time}
+    analysis_started = getattr(frame, '_analysis_started', None)
+    if queued_at is not None and analysis_started is not None:
+        timings['queue_wait'] = max(0.0, analysis_started - queued_at)
+
+    profile = None
+    if task is not None:
+        profile = profiling.sample(task.profile_rate, task.profile_top)
+        if profile is not None:
+            profile.start()
+
+    try:
+        started = time.time()
+        if frame.is_rollup():
+            frame.combine(stream_data)
+            # Child frames are not stream items
+            rows = 0
+        elif incremental:
+            rows = 0
+            for chunk in _timed_chunks(stream_data, timings):
+                frame.calculate_incremental(chunk)
+                rows += _count_rows(chunk) or 0
+            frame.finalize()
+        else:
+            frame.calculate(stream_data)
+            rows = _count_rows(stream_data)
+        timings['calculate'] = time.time() - started - (timings['fetch'] - fetch_time)
+
+        frame.mark_cleanup_started()
+
+        started = time.time()
+        frame.cleanup()
+        timings['cleanup'] = time.time() - started
+    finally:
+        if profile is not None:
+            profile.stop()
+
+    started = time.time()
+    frame.mark_done()
+    timings['db_write'] = time.time() - started
+
+    # Not counted until the frame is committed, in case the batch is rolled back and retried
+    models.on_commit(stats.record, frame, timings, rows)
+    if profile is not None:
+        models.on_commit(profiling.save, frame, profile)
+
+
+def _split_stream_data(stream, stream_data, frames):
+    """
+    Divides stream data covering several frames
+    into a list of items for each frame.
+    The frames may belong to different frame classes.
+    """
+
+    # The frames of each class lie on a grid of their duration
+    grids = {}
+    for frame in frames:
+        grid = grids.get(type(frame))
+        if grid is None:
+            grid = grids[type(frame)] = {
+                'origin': frame.start_time,
+                'duration': frame.duration,
+                'items_by_start': {},
+            }
+        grid['origin'] = min(grid['origin'], frame.start_time)
+        grid['items_by_start'][frame.start_time] = []
+
+    for item in stream_data:
+        item_time = stream.get_stream_item_time(item)
+        for grid in grids.itervalues():
+            offset = (item_time - grid['origin']).total_seconds()
+            if offset < 0:
+                continue
+
+            frame_start = grid['origin'] + grid['duration'] * int(offset // grid['duration'].total_seconds())
+            items = grid['items_by_start'].get(frame_start)
+            if items is not None:
+                items.append(item)
+
+    return [grids[type(frame)]['items_by_start'][frame.start_time] for frame in frames]
+
+
+def _catch_up_frame_ids(task, frame_class, frame_ids):
+    """
+    In catch-up mode, adds the waiting frames that directly follow
+    the given ones to frame_ids, up to catch_up_batch_size frames and
+    ANALYSIS_SHARED_FETCH_MAX_SPAN seconds of stream time in all.
+    This way frames that were queued one job at a time are worked off
+    in batches, and their own jobs find them claimed and do nothing.
+
+    Only later frames are added, so live jobs never take on backfill
+    frames: those are all older than the frames there were when
+    the backfill started, and wait on ANALYSIS_BACKFILL_QUEUE.
+    """
+    if task.get_mode() != task.CATCH_UP or len(frame_ids) >= task.catch_up_batch_size:
+        return frame_ids
+
+    frames = list(frame_class.objects
+                  .filter(pk__in=frame_ids, calculated=False, analysis_time__isnull=True)
+                  .order_by('start_time'))
+    if not frames or len(_group_by_partition(frames)) > 1:
+        return frame_ids
+
+    duration = frame_class.DURATION
+    max_span = datetime.timedelta(seconds=settings.SHARED_FETCH_MAX_SPAN)
+    next_start = frames[-1].end_time
+
+    waiting = frame_class.objects \
+        .filter(calculated=False, analysis_time__isnull=True,
+                start_time__gte=next_start, start_time__lte=frames[0].start_time + max_span - duration,
+                **frames[0].get_stream_filter()) \
+        .exclude(pk__in=frame_ids) \
+        .order_by('start_time') \
+        .values_list('pk', 'start_time')
+
+    # Stop at the first gap
+    extra_ids = []
+    for frame_id, start_time in waiting[:task.catch_up_batch_size - len(frame_ids)]:
+        if start_time != next_start:
+            break
+        extra_ids.append(frame_id)
+        next_start += duration
 
-    # Add any time frames that fit between the oldest stream data and the oldest time frame
-    frame_start = earliest - duration
-    if frame_start > earliest_allowable_start:
-        logger.info("Analyzing from %s to %s", earliest_allowable_start, frame_start)
+    return list(frame_ids) + extra_ids
 
-    while frame_start > earliest_allowable_start:
-        # go until we've overshot the stream front
-        # Create a new global (no word) time frame
-        new_time_frames.append(frame_class(start_time=frame_start))
-        frame_start -= duration
 
-    _insert_and_queue(task_key, new_time_frames)
+def _is_consecutive(frames):
+    """True if each of the frames, sorted by start time, starts where the one before ends."""
+    return all(frame.start_time == previous.end_time for previous, frame in zip(frames, frames[1:]))
 
 
-@django_rq.job
-def analyze_frame(task_key, frame_id):
+@backends.job
+def analyze_frame(task_key, frame_id, queued_at=None):
     """
     Run the analysis for a frame as part of a task.
+    queued_at is the time.time() when the job was queued.
+    In catch-up mode, waiting frames are analyzed along with it.
     """
 
     task = AnalysisTask.get(key=task_key)
     frame_class = task.get_frame_class()
     stream = frame_class.STREAM_CLASS()
 
-    frame = frame_class.objects.get(pk=frame_id)
+    if task.get_mode() == task.CATCH_UP:
+        return analyze_frames(task_key, [frame_id], queued_at=queued_at)
 
-    logger.info("Running %s frame #%s (%s)", task.name, str(frame.pk), frame.start_time)
+    # Make sure no other worker analyzes this frame
+    claimed = frame_class.claim_frames([frame_id])
+    if not claimed:
+        logger.info("Skipping %s frame #%s, already claimed", task.name, str(frame_id))
+        return
 
-    # Get the stream data for this time frame
-    stream_data = stream.get_stream_data(frame.start_time, frame.end_time)
+    frame = claimed[0]
+
+    # Keep the frame's lease alive while we work on it
+    with heartbeats.Heartbeat(claimed, task.frame_lease):
+        logger.info("Running %s frame #%s (%s)", task.name, str(frame.pk), frame.start_time)
+
+        # Get the stream data for this time frame
+        incremental = False
+        fetch_started = time.time()
+        if frame_class.is_rollup():
+            stream_data = _evaluate(frame.get_child_frames())
+        elif _uses_columns(frame, stream):
+            stream_data = _fetch_columns(stream, [frame])[0]
+        elif _is_incremental(frame, stream):
+            incremental = True
+            stream_data = stream.iter_stream_data(frame.start_time, frame.end_time, task.chunk_size,
+                                                  **frame.get_stream_filter())
+        else:
+            stream_data = _evaluate(stream.get_stream_data(frame.start_time, frame.end_time,
+                                                           **frame.get_stream_filter()))
+        fetch_time = time.time() - fetch_started
 
-    frame.mark_started()
+        _analyze(frame, stream_data, incremental=incremental, fetch_time=fetch_time, queued_at=queued_at, task=task)
 
-    frame.calculate(stream_data)
+    logger.info('Processed data from %s for %s frame #%s', frame_class.STREAM_CLASS.__name__, frame_class.__name__, str(frame_id))
 
-    frame.mark_cleanup_started()
 
-    frame.cleanup()
+@backends.job
+def analyze_frames(task_key, frame_ids, queued_at=None):
+    """
+    Run the analysis for several consecutive frames as part of a task.
+    queued_at is the time.time() when the job was queued.
 
-    frame.mark_done()
+    If the stream implements get_stream_item_time(), the stream data
+    for all of the frames is fetched with a single query,
+    as long as they are consecutive and belong to the same partition.
+    Frames with STREAM_COLUMNS share a get_stream_columns() query the same way.
 
-    logger.info('Processed data from %s for %s frame #%s', frame_class.STREAM_CLASS.__name__, frame_class.__name__, str(frame_id))
+    In catch-up mode, the waiting frames that follow the given ones
+    are claimed along with them, up to catch_up_batch_size frames.
+    """
+
+    task = AnalysisTask.get(key=task_key)
+    frame_class = task.get_frame_class()
+    stream = frame_class.STREAM_CLASS()
+
+    frame_ids = _catch_up_frame_ids(task, frame_class, frame_ids)
+    frames = frame_class.claim_frames(frame_ids)
+    if not frames:
+        logger.info("No %s frames left to analyze", task.name)
+        return
+
+    with heartbeats.Heartbeat(frames, task.frame_lease):
+        logger.info("Running %d %s frames (%s to %s)", len(frames), task.name, frames[0].start_time, frames[-1].end_time)
+
+        incremental = _is_incremental(frames[0], stream)
+        fetch_started = time.time()
+        if frame_class.is_rollup():
+            incremental = False
+            frame_data = [_evaluate(frame.get_child_frames()) for frame in frames]
+        elif _uses_columns(frames[0], stream):
+            incremental = False
+            frame_data = _fetch_columns(stream, frames)
+        elif incremental:
+            # Stream each frame's data separately to keep memory bounded
+            frame_data = [stream.iter_stream_data(frame.start_time, frame.end_time, task.chunk_size,
+                                                  **frame.get_stream_filter())
+                          for frame in frames]
+        elif _implements(stream, streams.AbstractStream, 'get_stream_item_time') \
+                and len(_group_by_partition(frames)) == 1 and _is_consecutive(frames):
+            stream_data = stream.get_stream_data(frames[0].start_time, frames[-1].end_time,
+                                                 **frames[0].get_stream_filter())
+            frame_data = _split_stream_data(stream, stream_data, frames)
+        else:
+            frame_data = [_evaluate(stream.get_stream_data(frame.start_time, frame.end_time,
+                                                           **frame.get_stream_filter()))
+                          for frame in frames]
+
+        # Share the fetch time between the frames
+        fetch_time = (time.time() - fetch_started) / len(frames)
+
+        # Save all of the results together, updating the watermarks once they are committed
+        with models.after_commit(), transaction.atomic():
+            for frame, stream_data in zip(frames, frame_data):
+                _analyze(frame, stream_data, incremental=incremental, fetch_time=fetch_time,
+                         queued_at=queued_at, task=task)
+
+    logger.info('Processed data from %s for %d %s frames', frame_class.STREAM_CLASS.__name__, len(frames), frame_class.__name__)
+
+
+def _group_into_windows(frames, max_span):
+    """
+    Groups frames, sorted by start time, into windows of stream time
+    no longer than max_span (a timedelta), unless a single frame is longer.
+    Returns a list of (start, end, frames) tuples.
+    """
+    windows = []
+    for frame in frames:
+        if windows and frame.end_time - windows[-1][0] <= max_span:
+            start, end, window_frames = windows[-1]
+            window_frames.append(frame)
+            windows[-1] = (start, max(end, frame.end_time), window_frames)
+        else:
+            windows.append((frame.start_time, frame.end_time, [frame]))
+    return windows
+
+
+def _fetch_shared(stream, can_split, start, end, frames):
+    """
+    Fetches the stream data for a window of frames as few times as possible.
+    Returns the stream data for each frame.
+    """
+    if can_split:
+        stream_data = stream.get_stream_data(start, end)
+        return _split_stream_data(stream, stream_data, frames)
+
+    # Only frames covering exactly the same time can share
+    data_by_window = {}
+    frame_data = []
+    for frame in frames:
+        key = (frame.start_time, frame.end_time)
+        if key not in data_by_window:
+            data_by_window[key] = _evaluate(stream.get_stream_data(frame.start_time, frame.end_time))
+        frame_data.append(data_by_window[key])
+    return frame_data
+
+
+@backends.job
+def analyze_stream_range(stream_group, start, end, queued_at=None):
+    """
+    Run the analysis for the frames of every task in the stream group
+    that lie between start and end.
+    queued_at is the time.time() when the job was queued.
+
+    Each stretch of stream data is fetched once and shared by all of
+    the frames that cover it. No more than ANALYSIS_SHARED_FETCH_MAX_SPAN
+    seconds of stream data are held at once.
+    """
+
+    tasks = [task for task in AnalysisTask.get() if task.stream_group == stream_group]
+    if not tasks:
+        logger.info("No tasks in stream group %s", stream_group)
+        return
+
+    stream_class = tasks[0].get_frame_class().STREAM_CLASS
+    stream = stream_class()
+
+    # Claim the waiting frames of every task in the group
+    tasks_by_frame = {}
+    frames = []
+    for task in tasks:
+        frame_class = task.get_frame_class()
+        if frame_class.STREAM_CLASS is not stream_class or frame_class.is_rollup() \
+                or frame_class.is_partitioned():
+            logger.warn("Task %s does not share the %s stream of group %s",
+                        task.name, stream_class.__name__, stream_group)
+            continue
+
+        frame_ids = frame_class.objects \
+            .filter(calculated=False, analysis_time__isnull=True,
+                    start_time__gte=start, start_time__lte=end - frame_class.DURATION) \
+            .values_list('pk', flat=True)
+        for frame in frame_class.claim_frames(list(frame_ids)):
+            tasks_by_frame[frame] = task
+            frames.append(frame)
+
+    if not frames:
+        logger.info("No frames left to analyze in stream group %s", stream_group)
+        return
+
+    lease_ttl = max(task.frame_lease for task in tasks)
+    with heartbeats.Heartbeat(frames, lease_ttl):
+        logger.info("Running %d frames in stream group %s (%s to %s)", len(frames), stream_group, start, end)
+
+        # Columnar and incremental frames fetch their own data
+        shared_frames = []
+        for frame in frames:
+            if _uses_columns(frame, stream):
+                fetch_started = time.time()
+                stream_data = _fetch_columns(stream, [frame])[0]
+                _analyze(frame, stream_data, fetch_time=time.time() - fetch_started,
+                         queued_at=queued_at, task=tasks_by_frame[frame])
+            elif _is_incremental(frame, stream):
+                task = tasks_by_frame[frame]
+                _analyze(frame, stream.iter_stream_data(frame.start_time, frame.end_time, task.chunk_size),
+                         incremental=True, queued_at=queued_at, task=task)
+            else:
+                shared_frames.append(frame)
+
+        shared_frames.sort(key=lambda f: f.start_time)
+        max_span = datetime.timedelta(seconds=settings.SHARED_FETCH_MAX_SPAN)
+        can_split = _implements(stream, streams.AbstractStream, 'get_stream_item_time')
+
+        for window_start, window_end, window_frames in _group_into_windows(shared_frames, max_span):
+            fetch_started = time.time()
+            frame_data = _fetch_shared(stream, can_split, window_start, window_end, window_frames)
+            fetch_time = (time.time() - fetch_started) / len(window_frames)
+
+            for frame, stream_data in zip(window_frames, frame_data):
+                _analyze(frame, stream_data, fetch_time=fetch_time, queued_at=queued_at,
+                         task=tasks_by_frame[frame])
+
+            # Let go of this window's stream data before fetching the next
+            del stream_data, frame_data
+
+    logger.info('Processed data from %s for %d frames in stream group %s',
+                stream_class.__name__, len(frames), stream_group)
 
 
 def get_stream_cutoff_times():
@@ -338,6 +1149,10 @@ def get_stream_cutoff_times():
     stream_class_memory_cutoffs = {}
     for task in tasks:
         frame_class = task.get_frame_class()
+        if frame_class.is_rollup():
+            # Rollup frames never read the stream
+            continue
+
         stream_class = frame_class.STREAM_CLASS
 
         if stream_class not in stream_class_memory_cutoffs:
@@ -352,25 +1167,71 @@ def get_stream_cutoff_times():
 
     return stream_class_memory_cutoffs
 
+def _stream_class_name(stream_class):
+    return '%s.%s' % (stream_class.__module__, stream_class.__name__)
+
+
 # up to 1 hour
-@django_rq.job('default', timeout=3600)
-def cleanup():
+@backends.job(timeout=3600)
+def cleanup(time_budget=None, max_rows_per_second=None, batch_size=None):
     """
     For all streams, deletes data that have been analyzed
     by all tasks that use those streams.
+
+    Data is deleted in batches of batch_size items (ANALYSIS_CLEANUP_BATCH_SIZE
+    by default), pausing ANALYSIS_CLEANUP_SLEEP seconds in between.
+    Optionally, stops after time_budget seconds and deletes no more
+    than max_rows_per_second on average. The next run starts
+    with the stream that was not finished.
     """
 
+    backend = backends.get_backend()
+    batch_size = batch_size or settings.CLEANUP_BATCH_SIZE
+    started = time.time()
+
     stream_class_memory_cutoffs = get_stream_cutoff_times()
 
+    # Resume with the stream we ran out of time on last time
+    unfinished = backend.get_state('cleanup').get('unfinished')
+    stream_classes = sorted(stream_class_memory_cutoffs,
+                            key=lambda c: (_stream_class_name(c) != unfinished, _stream_class_name(c)))
+
     total = 0
-    for stream_class, cutoff_time in stream_class_memory_cutoffs.iteritems():
+    for stream_class in stream_classes:
+        cutoff_time = stream_class_memory_cutoffs[stream_class]
         if cutoff_time is None:
             logger.info("Skipped cleaning for stream %s due to null cutoff time.", stream_class.__name__)
+            continue
+
         stream = stream_class()
-        deleted = stream.delete_before(cutoff_time)
+        deleted = 0
+        while True:
+            elapsed = time.time() - started
+            if time_budget is not None and elapsed >= time_budget:
+                logger.info("Cleanup ran out of time after %s stream items from %s.", deleted, stream_class.__name__)
+                metrics.stream_cleaned(_stream_class_name(stream_class), deleted)
+                backend.update_state('cleanup', {'unfinished': _stream_class_name(stream_class)})
+                return total
+
+            batch_deleted = stream.delete_batch_before(cutoff_time, batch_size)
+            deleted += batch_deleted
+            total += batch_deleted
+            if batch_deleted < batch_size:
+                break
+
+            # Pause between batches to let ingestion through
+            pause = settings.CLEANUP_SLEEP
+            if max_rows_per_second:
+                pause = max(pause, total / float(max_rows_per_second) - (time.time() - started))
+            if time_budget is not None:
+                pause = min(pause, time_budget - (time.time() - started))
+            if pause > 0:
+                time.sleep(pause)
+
         logger.info("Cleaned %s stream items before %s from %s.", deleted, cutoff_time, stream_class.__name__)
-        total += deleted
+        metrics.stream_cleaned(_stream_class_name(stream_class), deleted)
 
+    backend.update_state('cleanup', {'unfinished': ''})
     return total
 
 
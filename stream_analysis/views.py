@@ -0,0 +1,8 @@
+from django.http import HttpResponse
+import metrics
+from utils import AnalysisTask
+
+
+def metrics_view(request):
+    """Serves the analysis metrics for Prometheus to scrape."""
+    return HttpResponse(metrics.render(AnalysisTask.get()), content_type=metrics.CONTENT_TYPE)
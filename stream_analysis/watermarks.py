@@ -0,0 +1,138 @@
+"""
+Watermarks remember a few facts about each time frame class,
+so that scheduling does not need MAX/MIN aggregates
+over the frame table on every tick:
+
+latest_end: the end of the latest frame
+earliest_uncalculated: the start of the earliest uncalculated frame
+stream_latest: the latest stream time seen by create_frames
+
+They are kept in the backend state store, updated as frames are
+inserted and calculated, and recalculated from the database
+whenever they are missing or have been invalidated.
+
+Each stored value is tagged with the generation it was computed in.
+Invalidating a watermark just bumps its generation, so a value computed
+concurrently from older data is never mistaken for a current one.
+"""
+
+from django.utils.dateparse import parse_datetime
+import backends
+import heartbeats
+import settings
+
+LATEST_END = 'latest_end'
+EARLIEST_UNCALCULATED = 'earliest_uncalculated'
+STREAM_LATEST = 'stream_latest'
+
+WATERMARKS = (LATEST_END, EARLIEST_UNCALCULATED, STREAM_LATEST)
+
+
+def _state_name(frame_class):
+    return 'watermarks:%s' % frame_class._meta.db_table
+
+
+def _generation(state, watermark):
+    return state.get(watermark + '.gen', '0')
+
+
+def _compute(frame_class, watermark):
+    """Work out a watermark from scratch."""
+    if watermark == LATEST_END:
+        return frame_class.get_latest_end_time()
+    elif watermark == EARLIEST_UNCALCULATED:
+        exclude_ids = None
+        if settings.EXCLUDE_DEAD_FRAMES:
+            exclude_ids = heartbeats.get_dead(frame_class).keys()
+        return frame_class.get_earliest_uncalculated_start_time(exclude_ids=exclude_ids)
+    elif watermark == STREAM_LATEST:
+        return frame_class.STREAM_CLASS().get_latest_stream_time()
+    raise ValueError("Unknown watermark %s" % watermark)
+
+
+def _lookup(state, watermark):
+    """
+    Returns (True, value) if the state holds a current value
+    for the watermark, or (False, None).
+    """
+    stored = state.get(watermark)
+    if stored is None:
+        return False, None
+
+    generation, _, value = stored.partition('|')
+    if generation != _generation(state, watermark):
+        return False, None
+
+    return True, parse_datetime(value) if value else None
+
+
+def _store(frame_class, state, watermark, value):
+    """Saves a watermark value, tagged with the generation in state."""
+    stored = '%s|%s' % (_generation(state, watermark), value.isoformat() if value is not None else '')
+    backends.get_backend().update_state(_state_name(frame_class), {watermark: stored})
+
+
+def get(frame_class, watermark):
+    """
+    Returns a watermark datetime for the frame class, or None.
+    It is recalculated from the database if necessary.
+    """
+    state = backends.get_backend().get_state(_state_name(frame_class))
+
+    found, value = _lookup(state, watermark)
+    if not found:
+        value = _compute(frame_class, watermark)
+        _store(frame_class, state, watermark, value)
+
+    return value
+
+
+def record(frame_class, watermark, value):
+    """Records a known watermark value."""
+    state = backends.get_backend().get_state(_state_name(frame_class))
+    _store(frame_class, state, watermark, value)
+
+
+def invalidate(frame_class, *names):
+    """Makes sure the named watermarks are recalculated the next time they are needed."""
+    backends.get_backend().increment_state(_state_name(frame_class),
+                                           dict((name + '.gen', 1) for name in names))
+
+
+def rebuild(frame_class):
+    """Recalculates all of the watermarks for the frame class. Returns them."""
+    invalidate(frame_class, *WATERMARKS)
+    return dict((watermark, get(frame_class, watermark)) for watermark in WATERMARKS)
+
+
+def frames_inserted(frame_class, frames):
+    """Updates the watermarks for newly inserted frames."""
+    if not frames:
+        return
+
+    state = backends.get_backend().get_state(_state_name(frame_class))
+
+    found, latest_end = _lookup(state, LATEST_END)
+    new_latest_end = max(frame.end_time for frame in frames)
+    if found and (latest_end is None or new_latest_end > latest_end):
+        _store(frame_class, state, LATEST_END, new_latest_end)
+    elif not found:
+        invalidate(frame_class, LATEST_END)
+
+    # New frames may be earlier than the earliest uncalculated frame
+    found, earliest = _lookup(state, EARLIEST_UNCALCULATED)
+    if not found or earliest is None or min(frame.start_time for frame in frames) < earliest:
+        invalidate(frame_class, EARLIEST_UNCALCULATED)
+
+
+def frame_calculated(frame):
+    """Updates the watermarks for a frame that has just been calculated."""
+    frame_class = type(frame)
+    state = backends.get_backend().get_state(_state_name(frame_class))
+
+    found, earliest = _lookup(state, EARLIEST_UNCALCULATED)
+    if found and earliest is not None and earliest < frame.start_time:
+        # Some earlier frame is still uncalculated
+        return
+
+    invalidate(frame_class, EARLIEST_UNCALCULATED)